@@ -8,19 +8,28 @@
 #
 #       Note that step 2 discards data that have too much NaN values, but still retains data
 #       with less than 5% of the NaN. This script will further fix all the NaN values in these
-#       files before feeding into DL models. Should be a class with different NaN filling 
-#       method, so it can be re-used.
+#       files before feeding into DL models. The filling method is a NaNFiller chosen with
+#       fill_method, so it can be re-used.
 #
 # FUNCTIONS:
 #       - calfield: Calculates normalized vector fields from 2D arrays.
 #       - elewise_dot: Computes element-wise dot products between two vectors.
 #       - weight_field: Calculates weights for vector fields based on predefined directions.
 #       - shift: Shifts array elements along specified axis and fills shifted positions with zeros.
-#       - extract_bound: Identifies boundary elements in 2D arrays adjacent to NaN values.
-#       - fill4, fill3, fill2: Fill NaN values using 4-cell, 3-cell, and 2-cell patterns, considering
-#         vector fields to maintain spatial coherence in wind data.
+#       - extract_bound, nan_bound: Identifies boundary elements in 2D arrays adjacent to NaN values.
+#       - pending_cells, stencil_waves: Find the NaN values with a given number of valid neighbours and
+#         the waves they are filled in.
+#       - fill_cells: Fills one wave of NaN values, considering vector fields to maintain spatial coherence in wind data.
+#       - fill_stencil: Fills the NaN values with a given number of valid neighbours, vectorized over all of them.
+#       - fill4, fill3, fill2: Fill NaN values using 4-cell, 3-cell, and 2-cell patterns with fill_stencil.
 #       - fill_nan: Coordinates the sequence of filling functions to ensure comprehensive coverage of NaNs.
+#       - plan_fill, FillPlanCache: Work out the fill schedule of fill_nan from the NaN mask, and cache it per mask.
+#       - nearest_plan, laplace_plan: Work out the nearest valid cells, or the Laplace system, of a NaN mask.
+#       - NaNFiller, WindFiller, NearestFiller, LaplaceFiller, make_filler: The NaN filling methods of fix_data.
+#       - fill_batch: The same as fill_nan on a batch of samples, replaying their cached schedules together.
+#       - nan_rows, fill_rows, fill_task: Find the samples with NaNs and fill them in place, in a process pool.
 #       - fix_data: Applies NaN filling operations to data files, ensuring data consistency and reliability.
+#       - check_channels: Checks the channel layout written by TC-extract_data.py against the one fix_data expects.
 #
 # USAGE: Adjust the root directory to point to your data files and run the script. It will automatically
 #       find and process files that require NaN filling and save the corrected files.
@@ -35,7 +44,9 @@
 #
 #       The algorithm is not completed, and should not be used for dataset with > 5% missing data. One should 
 #       find a way to handle large border missing patterns or any big rip near the center of the domain. 
-#       Also loop filling is not efficient, see line 225.
+#       For such data use fill_method 'nearest' or 'laplace', which fill any gap of a field with valid values,
+#       and raise omit_percent in TC-extract_data.py accordingly.
+#       The filling is vectorized over the NaN cells of each pattern, see fill_stencil.
 #
 # HIST: - May 14, 2024: Created by Khanh Luong
 #       - May 16, 2024: cleaned up and added more note by CK
@@ -48,6 +59,13 @@ import os
 import numpy as np
 import copy
 import glob
+import json
+import collections
+import shutil
+import multiprocessing
+import scipy.ndimage
+import scipy.sparse
+import scipy.sparse.linalg
 np.seterr(invalid='ignore')
 #
 # Set input parameters and data path properly before running. All input and output
@@ -55,6 +73,14 @@ np.seterr(invalid='ignore')
 #
 workdir='/N/slate/kmluong/TC-net-cnn_workdir/Domain_data/'
 var_num = 13
+fill_method = 'wind'   # 'wind': the wind-aware stencil below, 'nearest': nearest valid value, 'laplace': smooth
+                       # (harmonic) inpainting. The last two also fill large and border gaps, see make_filler
+batch_size = 4096      # samples filled together
+plan_cache_size = 20000  # fill plans kept by the filler, one per NaN mask
+fix_mode = 'memmap'    # 'copy': load the features and save a fixed copy, 'memmap': copy the file to the
+                       # fixed one and fill it in place, 'inplace': fill the features in place and rename
+                       # them to the fixed file. Only the samples with NaNs are read and written in the last two
+nworkers = int(os.environ.get('SLURM_CPUS_PER_TASK', 1))   # processes filling disjoint ranges of the samples
 windowsize = [18,18]
 
 #####################################################################################
@@ -140,77 +166,130 @@ def extract_bound(array):
     Extract the boundary of a 2D array containing NaN values.
 
     Parameters:
-    - array: 2D array containing NaN values.
+    - array: 2D array containing NaN values, or a stack of them along the leading axes.
 
     Returns:
     - bound: 2D boolean array representing the boundary.
     """
-    nan = np.isnan(array)
+    return nan_bound(np.isnan(array))
+
+def nan_bound(nan):
+    """
+    Extract the boundary of a NaN mask, the cells that are not NaN but have a NaN among their 4
+    neighbours, see extract_bound.
+
+    Parameters:
+    - nan: 2D boolean array, or a stack of them along the leading axes.
+
+    Returns:
+    - bound: boolean array of the same shape.
+    """
+    padded = np.zeros(nan.shape[:-2] + (nan.shape[-2] + 2, nan.shape[-1] + 2), dtype=bool)  # the same as shift,
+    padded[..., 1:-1, 1:-1] = nan                                            # views of a padded mask, not rolled copies
     notnan = np.logical_not(nan)
-    s1 = np.logical_and(notnan, shift(nan, 1))
-    s2 = np.logical_and(notnan, shift(nan, -1))
-    s3 = np.logical_and(notnan, shift(nan, 1, mode=1))
-    s4 = np.logical_and(notnan, shift(nan, -1, mode=1))
-    bound = np.logical_or(s1, np.logical_or(s2, np.logical_or(s3, s4)))
+    bound = np.logical_and(notnan, padded[..., :-2, 1:-1] | padded[..., 2:, 1:-1] | padded[..., 1:-1, :-2] | padded[..., 1:-1, 2:])
     return bound
 
-def fill4(array):
+def pending_cells(nan, count):
     """
-    Fills NaN values in the input array with a 4-cell pattern.
+    Find the NaN cells whose 4 neighbours include count boundary cells, the cells filled by fill4,
+    fill3 or fill2. The cells on the edges of the grid are never filled.
 
     Parameters:
-    - array: numpy array
+    - nan: boolean array of shape (samples, lat, lon), the NaN mask of the first channel.
+    - count: int, 4, 3 or 2.
 
     Returns:
-    - numpy array
+    - pending: boolean array of the same shape.
     """
-    bound = extract_bound(array[0])
-    nan4 = np.zeros(bound.shape)
-    nan4[1:-1, 1:-1] = nan4[1:-1, 1:-1] + bound[1:-1, :-2] + bound[1:-1, 2:] + bound[:-2, 1:-1] + bound[2:, 1:-1]
-    nan4 = np.logical_and(nan4 == 4, np.isnan(array[0]))
+    bound = nan_bound(nan)
+    nanc = np.zeros(bound.shape)
+    nanc[:, 1:-1, 1:-1] = nanc[:, 1:-1, 1:-1] + bound[:, 1:-1, :-2] + bound[:, 1:-1, 2:] + bound[:, :-2, 1:-1] + bound[:, 2:, 1:-1]
+    return np.logical_and(nanc == count, nan)
 
-    if np.sum(nan4) == 0:
-        return array
+def stencil_waves(pending):
+    """
+    Split the pending cells into the waves they are filled in. The original loop filled them one at
+    a time in row-major order, so a wave holds the pending cells with no unfilled pending cell above
+    or to the left in their 3x3 window: each of them sees exactly the values the loop gave it, and
+    no two cells of a wave are in the window of each other.
 
-    for i in np.transpose(nan4.nonzero()):
-        vector = calfield(array)
-        weight = weight_field(vector[i[0] - 1:i[0] + 2, i[1] - 1:i[1] + 2])
+    Parameters:
+    - pending: boolean array of shape (samples, lat, lon), cleared as the waves are yielded.
 
-        for j in range(len(array) - 1):
-            array[j, i[0], i[1]] = np.nansum(array[j, i[0] - 1:i[0] + 2, i[1] - 1:i[1] + 2] * weight)
+    Yields:
+    - tuple: the samples, rows and columns of the cells of each wave.
+    """
+    padded = np.zeros((pending.shape[0], pending.shape[1] + 2, pending.shape[2] + 2), dtype=bool)
+    while pending.any():
+        padded[:, 1:-1, 1:-1] = pending
+        earlier = padded[:, :-2, :-2] | padded[:, :-2, 1:-1] | padded[:, :-2, 2:] | padded[:, 1:-1, :-2]
+        ready = np.logical_and(pending, np.logical_not(earlier))
+        samples, rows, cols = ready.nonzero()
+        pending[samples, rows, cols] = False
+        yield samples, rows, cols
+
+def fill_cells(values, vector, samples, rows, cols):
+    """
+    Fill one wave of cells with the 3x3 stencil weighted by the wind field (see weight_field), and
+    update the normalized wind field at the filled cells. The 3x3 windows of the wave are gathered
+    at once with shifted index grids, and all the channels are filled in one operation.
 
-    return array
+    Parameters:
+    - values: numpy array of shape (channels, samples, lat, lon), with U and V as the first two
+      channels, filled in place.
+    - vector: numpy array of shape (samples, lat, lon, 2), calfield of values, updated in place.
+    - samples, rows, cols: 1D int arrays, the cells of the wave (see stencil_waves).
 
-def fill3(array):
+    Returns:
+    - None
     """
-    Fills NaN values in the input array with a 3-cell pattern.
+    C2 = np.sqrt(2) / 2
+    direction_array = np.array([[[C2, -C2], [0, -1], [-C2, -C2]],
+                                [[1, 0], [0, 0], [-1, 0]],
+                                [[C2, C2], [0, 1], [-C2, C2]]])
+    offset = np.arange(-1, 2)
+    window_samples = samples[:, None, None]
+    window_rows = rows[:, None, None] + offset[:, None]   # 3x3 windows of the wave, (cells, 3, 3)
+    window_cols = cols[:, None, None] + offset[None, :]
+    window = vector[window_samples, window_rows, window_cols]
+    weight = np.abs(window[..., 0] * direction_array[:, :, 0] + window[..., 1] * direction_array[:, :, 1])
+    weight = weight / np.nansum(weight, axis=(1, 2), keepdims=True)
+    values[:, samples, rows, cols] = np.nansum(values[:, window_samples, window_rows, window_cols] * weight, axis=(2, 3))
+    vector[samples, rows, cols] = calfield(values[:2, samples, rows, cols])
+
+def fill_stencil(array, count):
+    """
+    Fills the NaN values of the input array whose 4 neighbours include count boundary cells, with
+    the wind-weighted 3x3 stencil. This is the vectorized form of the original loop, which filled
+    the candidates one at a time in row-major order and recomputed calfield on the whole field for
+    each of them. Here the normalized wind field is computed once and the candidates are filled in
+    the waves of stencil_waves, with fill_cells. The samples of a batch are independent, so their
+    waves run together.
 
     Parameters:
-    - array: numpy array
+    - array: numpy array of shape (samples, channels, lat, lon), with U and V as the first two
+      channels. All channels but the last are filled, in place.
+    - count: int, 4, 3 or 2, the number of boundary cells around the filled NaN values.
 
     Returns:
     - numpy array
     """
-    bound = extract_bound(array[0])
-    nan3 = np.zeros(bound.shape)
-    nan3[1:-1, 1:-1] = nan3[1:-1, 1:-1] + bound[1:-1, :-2] + bound[1:-1, 2:] + bound[:-2, 1:-1] + bound[2:, 1:-1]
-    nan3 = np.logical_and(nan3 == 3, np.isnan(array[0]))
+    pending = pending_cells(np.isnan(array[:, 0]), count)
 
-    if np.sum(nan3) == 0:
+    if not pending.any():
         return array
 
-    for i in np.transpose(nan3.nonzero()):
-        vector = calfield(array)
-        weight = weight_field(vector[i[0] - 1:i[0] + 2, i[1] - 1:i[1] + 2])
-
-        for j in range(len(array) - 1):
-            array[j, i[0], i[1]] = np.nansum(array[j, i[0] - 1:i[0] + 2, i[1] - 1:i[1] + 2] * weight)
+    values = array[:, :-1].swapaxes(0, 1)        # (channels, samples, lat, lon) view of the filled channels
+    vector = calfield(values)
+    for samples, rows, cols in stencil_waves(pending):
+        fill_cells(values, vector, samples, rows, cols)
 
     return array
 
-def fill2(array):
+def fill4(array):
     """
-    Fills NaN values in the input array with a 2-cell pattern.
+    Fills NaN values in the input array with a 4-cell pattern.
 
     Parameters:
     - array: numpy array
@@ -218,22 +297,31 @@ def fill2(array):
     Returns:
     - numpy array
     """
-    bound = extract_bound(array[0])
-    nan2 = np.zeros(bound.shape)
-    nan2[1:-1, 1:-1] = nan2[1:-1, 1:-1] + bound[1:-1, :-2] + bound[1:-1, 2:] + bound[:-2, 1:-1] + bound[2:, 1:-1]
-    nan2 = np.logical_and(nan2 == 2, np.isnan(array[0]))
+    return fill_stencil(array[None], 4)[0]
 
-    if np.sum(nan2) == 0:
-        return array
+def fill3(array):
+    """
+    Fills NaN values in the input array with a 3-cell pattern.
 
-    for i in np.transpose(nan2.nonzero()):
-        vector = calfield(array)
-        weight = weight_field(vector[i[0] - 1:i[0] + 2, i[1] - 1:i[1] + 2])
+    Parameters:
+    - array: numpy array
 
-        for j in range(len(array) - 1):
-            array[j, i[0], i[1]] = np.nansum(array[j, i[0] - 1:i[0] + 2, i[1] - 1:i[1] + 2] * weight)
+    Returns:
+    - numpy array
+    """
+    return fill_stencil(array[None], 3)[0]
 
-    return array
+def fill2(array):
+    """
+    Fills NaN values in the input array with a 2-cell pattern.
+
+    Parameters:
+    - array: numpy array
+
+    Returns:
+    - numpy array
+    """
+    return fill_stencil(array[None], 2)[0]
 
 def fill_nan(array):
     """
@@ -263,40 +351,489 @@ def fill_nan(array):
     array = array[:, 1:-1, 1:-1]
     return array
 
-def fix_data(file):
+def plan_fill(nan):
+    """
+    Work out the fill schedule of fill_nan from the NaN masks alone: which cells are filled, and in
+    which wave, by the sweeps of fill4, fill3 and fill2 and then by the padded loop. Filled cells are
+    never NaN, so the schedule does not depend on the data. The masks are planned together, and those
+    without NaN left in the interior drop out of the later sweeps of the first loop.
+
+    Parameters:
+    - nan: boolean array of shape (samples, lat, lon), the NaN masks of the first channel.
+
+    Returns:
+    - list: one plan per mask, the rows, columns and wave numbers of the filled cells in the frame
+      of the padded array, ordered by wave.
+    """
+    nan = nan.copy()
+    waves = []
+    active = np.flatnonzero(nan[:, 1:-1, 1:-1].any(axis=(1, 2)))
+    hold1=0
+    while len(active) > 0:
+        part = nan[active]
+        for count in (4, 3, 2):
+            for samples, rows, cols in stencil_waves(pending_cells(part, count)):
+                part[samples, rows, cols] = False
+                waves.append((active[samples], rows + 1, cols + 1))
+        nan[active] = part
+        hold1+=1
+        if hold1==300:
+            break
+        active = active[part[:, 1:-1, 1:-1].any(axis=(1, 2))]
+    #
+    # fill_nan pads every sample, but only those with NaNs left on the border or after the 300
+    # sweeps have anything to fill in the padded loop
+    #
+    active = np.flatnonzero(nan.any(axis=(1, 2)))
+    if len(active) > 0:
+        part = np.pad(nan[active], [[0, 0], [1, 1], [1, 1]])
+        while part[:, 1:-1, 1:-1].any():
+            for count in (4, 3, 2):
+                for samples, rows, cols in stencil_waves(pending_cells(part, count)):
+                    part[samples, rows, cols] = False
+                    waves.append((active[samples], rows, cols))
+
+    if len(waves) == 0:
+        return [(np.zeros(0, dtype=np.int16),) * 3 for i in range(len(nan))]
+    samples = np.concatenate([wave[0] for wave in waves])
+    rows = np.concatenate([wave[1] for wave in waves]).astype(np.int16)
+    cols = np.concatenate([wave[2] for wave in waves]).astype(np.int16)
+    number = np.repeat(np.arange(len(waves)), [len(wave[0]) for wave in waves])
+    order = np.argsort(samples, kind='stable')   # keeps the cells of each sample in wave order
+    split = np.searchsorted(samples[order], np.arange(len(nan) + 1))
+    plans = []
+    for i in range(len(nan)):
+        cells = order[split[i]:split[i+1]]
+        # renumber the waves of the sample from 0, skipping the waves it had no cell in
+        wave = np.concatenate(([0], np.cumsum(number[cells][1:] != number[cells][:-1]))).astype(np.int16)
+        plans.append((rows[cells], cols[cells], wave[:len(cells)]))
+    return plans
+
+def nearest_plan(nan):
+    """
+    Work out, for each NaN mask, the nearest valid cell of each NaN cell with the Euclidean
+    distance transform.
+
+    Parameters:
+    - nan: boolean array of shape (masks, lat, lon), each with at least one valid cell.
+
+    Returns:
+    - list: one plan per mask, the flat indices of the NaN cells and of their nearest valid cells.
+    """
+    plans = []
+    for mask in nan:
+        index = scipy.ndimage.distance_transform_edt(mask, return_distances=False, return_indices=True)
+        cells = np.flatnonzero(mask)
+        plans.append((cells, np.ravel_multi_index(tuple(index), mask.shape).ravel()[cells]))
+    return plans
+
+def laplace_plan(nan):
+    """
+    Set up, for each NaN mask, the discrete Laplace equation of the NaN cells: each NaN cell is the
+    mean of its 4 neighbours inside the grid, the valid ones being the boundary values. Every NaN
+    region touches a valid cell, so the system is not singular, and it is factorized once per mask.
+
+    Parameters:
+    - nan: boolean array of shape (masks, lat, lon), each with at least one valid cell.
+
+    Returns:
+    - list: one plan per mask, the flat indices of the NaN cells, the LU factors of the system, and
+      the sparse matrix giving its right-hand side from a flattened field.
+    """
+    plans = []
+    for mask in nan:
+        nlat, nlon = mask.shape
+        cells = np.flatnonzero(mask)
+        number = np.full(mask.size, -1)
+        number[cells] = np.arange(len(cells))
+        rows, cols = np.divmod(cells, nlon)
+        degree = np.zeros(len(cells))
+        inner = ([], [], [])     # entries of the system between NaN cells
+        bound = ([], [])         # the valid neighbours of each NaN cell, summed into the right-hand side
+        for drow, dcol in ((-1, 0), (1, 0), (0, -1), (0, 1)):
+            inside = (rows + drow >= 0) & (rows + drow < nlat) & (cols + dcol >= 0) & (cols + dcol < nlon)
+            degree += inside
+            neighbour = (rows + drow) * nlon + cols + dcol
+            isnan = inside & mask.ravel()[np.where(inside, neighbour, 0)]
+            inner[0].append(np.flatnonzero(isnan))
+            inner[1].append(number[neighbour[isnan]])
+            bound[0].append(np.flatnonzero(inside & ~isnan))
+            bound[1].append(neighbour[inside & ~isnan])
+        i = np.concatenate([np.arange(len(cells))] + inner[0])
+        j = np.concatenate([np.arange(len(cells))] + inner[1])
+        data = np.concatenate([degree] + [-np.ones(len(k)) for k in inner[0]])
+        system = scipy.sparse.csc_matrix((data, (i, j)), shape=(len(cells), len(cells)))
+        i = np.concatenate(bound[0])
+        rhs = scipy.sparse.csr_matrix((np.ones(len(i)), (i, np.concatenate(bound[1]))), shape=(len(cells), mask.size))
+        plans.append((cells, scipy.sparse.linalg.splu(system), rhs))
+    return plans
+
+class FillPlanCache:
+    """
+    LRU cache of fill plans keyed by the NaN mask, the schedules of plan_fill by default. The NaNs
+    of the features come from the terrain crossing the pressure levels, so the same masks come back
+    for all the fixes of a storm near the same coast, and their plans are reused instead of being
+    worked out again.
+
+    Parameters:
+    - maxsize (int): The number of plans kept, the least recently used are dropped first.
+    - plan (function): Works out the plans of a stack of masks, see plan_fill, nearest_plan and laplace_plan.
+    """
+    def __init__(self, maxsize=10000, plan=plan_fill):
+        self.maxsize = maxsize
+        self.plan = plan
+        self.plans = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, nan):
+        """
+        Get the plans of a stack of NaN masks, planning the missing ones together.
+
+        Parameters:
+        - nan: boolean array of shape (samples, lat, lon)
+
+        Returns:
+        - list: the plan of each mask.
+        """
+        packed = np.packbits(nan.reshape(len(nan), -1), axis=1)
+        keys = [(nan.shape[1:], row.tobytes()) for row in packed]
+        found = {}
+        missing = []
+        for i, key in enumerate(keys):
+            if key in found:
+                self.hits += 1
+            elif key in self.plans:
+                self.plans.move_to_end(key)
+                found[key] = self.plans[key]
+                self.hits += 1
+            else:
+                found[key] = None
+                missing.append(i)
+                self.misses += 1
+        if len(missing) > 0:
+            for i, plan in zip(missing, self.plan(nan[missing])):
+                found[keys[i]] = plan
+                self.plans[keys[i]] = plan
+            while len(self.plans) > self.maxsize:
+                self.plans.popitem(last=False)
+        return [found[key] for key in keys]
+
+    def stats(self):
+        """
+        Summary of the cache use, with the hit rate over the masks looked up.
+        """
+        lookups = self.hits + self.misses
+        rate = 100 * self.hits / lookups if lookups > 0 else 0.
+        return (str(self.hits) + ' hits, ' + str(self.misses) + ' misses (' + str(round(rate, 1))
+                + '% hit rate), ' + str(len(self.plans)) + ' plans cached')
+
+def fill_batch(batch, cache):
+    """
+    Fills NaN values in a batch of arrays, the same as fill_nan on each of them. The fill schedule
+    of each sample comes from the cache (see plan_fill), and the schedules of the batch are replayed
+    together: wave t of the batch holds wave t of every sample.
+
+    Parameters:
+    - batch: numpy array of shape (samples, channels, lat, lon)
+    - cache: FillPlanCache
+
+    Returns:
+    - numpy array
+    """
+    plans = cache.get(np.isnan(batch[:, 0]))
+    active = np.array([i for i, plan in enumerate(plans) if len(plan[0]) > 0], dtype=int)
+    if len(active) == 0:
+        return batch
+    samples = np.repeat(np.arange(len(active)), [len(plans[i][0]) for i in active])
+    rows = np.concatenate([plans[i][0] for i in active]).astype(int)
+    cols = np.concatenate([plans[i][1] for i in active]).astype(int)
+    wave = np.concatenate([plans[i][2] for i in active])
+    order = np.argsort(wave, kind='stable')
+    split = np.searchsorted(wave[order], np.arange(wave.max() + 2))
+
+    part = np.pad(batch[active], [[0, 0], [0, 0], [1, 1], [1, 1]])
+    values = part[:, :-1].swapaxes(0, 1)         # (channels, samples, lat, lon) view of the filled channels
+    vector = calfield(values)
+    for t in range(len(split) - 1):
+        cells = order[split[t]:split[t+1]]
+        fill_cells(values, vector, samples[cells], rows[cells], cols[cells])
+    batch[active] = part[:, :, 1:-1, 1:-1]
+    return batch
+
+class NaNFiller:
+    """
+    A NaN filling method of fix_data, see make_filler. A filler fills the NaN values of a block of
+    samples at once, and keeps the plans it works out for each NaN mask in a FillPlanCache.
+
+    Parameters:
+    - cache_size (int): The number of plans kept, see FillPlanCache.
+    """
+    plan = None
+
+    def __init__(self, cache_size=10000):
+        self.cache = FillPlanCache(cache_size, type(self).plan)
+
+    def fill(self, block):
+        """
+        Fill the NaN values of a block of samples.
+
+        Parameters:
+        - block: numpy array of shape (samples, channels, lat, lon), filled in place.
+
+        Returns:
+        - numpy array
+        """
+        raise NotImplementedError
+
+class WindFiller(NaNFiller):
+    """
+    The wind-aware stencil filling of fill_nan, run on each 4-channel group of the block with
+    fill_batch. The NaN mask of the first channel (U) of a group drives the filling of the group.
+    """
+    plan = staticmethod(plan_fill)
+
+    def fill(self, block):
+        for j in range(block.shape[1]//4):
+            block[:, j*4:4*j+5] = fill_batch(block[:, j*4:4*j+5], self.cache)
+        return block
+
+class FieldFiller(NaNFiller):
+    """
+    Base of the fillers working on each 2D field (one channel of one sample) with its own NaN mask.
+    The fields sharing a mask are filled together with the plan of the mask, see apply. Fields
+    with no valid value at all are left as they are.
+    """
+    def fill(self, block):
+        fields = block.reshape(-1, block.shape[2] * block.shape[3])
+        nan = np.isnan(fields)
+        todo = np.flatnonzero(nan.any(axis=1) & ~nan.all(axis=1))
+        if len(todo) == 0:
+            return block
+        groups = {}
+        for k, plan in zip(todo, self.cache.get(nan[todo].reshape(-1, block.shape[2], block.shape[3]))):
+            groups.setdefault(id(plan), (plan, []))[1].append(k)
+        for plan, ks in groups.values():
+            fields[ks] = self.apply(plan, fields[ks])
+        return fields.reshape(block.shape)
+
+    def apply(self, plan, fields):
+        """
+        Fill flattened fields sharing a NaN mask with the plan of the mask.
+
+        Parameters:
+        - plan: the plan of the mask
+        - fields: numpy array of shape (fields, lat*lon)
+
+        Returns:
+        - numpy array
+        """
+        raise NotImplementedError
+
+class NearestFiller(FieldFiller):
+    """
+    Fill each NaN value with the nearest valid value of its field, see nearest_plan. Fast, and
+    whatever the size of the gaps, but blocky over large ones.
+    """
+    plan = staticmethod(nearest_plan)
+
+    def apply(self, plan, fields):
+        cells, source = plan
+        fields[:, cells] = fields[:, source]
+        return fields
+
+class LaplaceFiller(FieldFiller):
+    """
+    Fill the NaN values of each field with the smooth (harmonic) surface that matches the valid
+    values around the gaps, see laplace_plan. The system of a mask is factorized once and solved
+    for all the fields sharing the mask at once.
+    """
+    plan = staticmethod(laplace_plan)
+
+    def apply(self, plan, fields):
+        cells, lu, rhs = plan
+        fields[:, cells] = lu.solve(np.asarray(rhs @ np.nan_to_num(fields, nan=0.).T)).T
+        return fields
+
+def make_filler(method, cache_size=10000):
+    """
+    Make the NaN filler of fill_method.
+
+    Parameters:
+    - method: str, 'wind', 'nearest' or 'laplace'
+    - cache_size: int, the number of plans kept, see FillPlanCache
+
+    Returns:
+    - NaNFiller
+    """
+    fillers = {'wind': WindFiller, 'nearest': NearestFiller, 'laplace': LaplaceFiller}
+    if method not in fillers:
+        raise ValueError('Unknown fill_method ' + str(method) + ', use ' + ', '.join(fillers))
+    return fillers[method](cache_size)
+
+def nan_rows(xa, rows, block_size=4096):
     """
-    Fixes NaN values in the data stored in the given file using the fill_nan function.
+    Find the samples with NaNs among the given ones, reading them block by block so that a
+    memory-mapped array is never loaded whole.
+
+    Parameters:
+    - xa: numpy array or memmap of shape (samples, channels, lat, lon)
+    - rows: the indices of the samples to check
+    - block_size: int, the number of samples read at a time
+
+    Returns:
+    - numpy array of the indices of the samples with NaNs
+    """
+    rows = np.asarray(rows, dtype=int)
+    found = [rows[start:start+block_size][np.isnan(xa[rows[start:start+block_size]]).any(axis=(1, 2, 3))]
+             for start in range(0, len(rows), block_size)]
+    return np.concatenate(found) if len(found) > 0 else rows
+
+def fill_rows(xa, rows, filler):
+    """
+    Fills the NaN values of the given samples of xa in place, batch_size samples at a time. Only
+    these samples are read and written, so xa can be a memmap.
+
+    Parameters:
+    - xa: numpy array or memmap of shape (samples, channels, lat, lon)
+    - rows: numpy array of the indices of the samples with NaNs, see nan_rows
+    - filler: NaNFiller
+
+    Returns:
+    - None
+    """
+    for start in range(0, len(rows), batch_size):
+        block = rows[start:start+batch_size]
+        xa[block] = filler.fill(xa[block])
+
+def fill_task(args):
+    """
+    Pool task filling a range of samples of a .npy file in place, through its own memmap.
+
+    Parameters:
+    - args: tuple (filename, rows)
+
+    Returns:
+    - tuple: the number of samples filled, and the hits and misses of the plan cache of the worker.
+    """
+    filename, rows = args
+    hits, misses = filler.cache.hits, filler.cache.misses
+    xa = np.load(filename, mmap_mode='r+')
+    fill_rows(xa, rows, filler)
+    xa.flush()
+    return len(rows), filler.cache.hits - hits, filler.cache.misses - misses
+
+def fix_data(file, pool=None):
+    """
+    Fixes NaN values in the data stored in the given file with the filler of fill_method. The fixed
+    data goes to the same name ending with fixed.npy, see fix_mode.
 
     Parameters:
     - file: str
         The file path for the data.
+    - pool: multiprocessing pool or None
+        The workers filling disjoint ranges of the samples with NaNs, if fix_mode is not 'copy'.
 
     Returns:
     - None
     """
-    xa = np.load(file)
+    fixed = file[:-4]+'fixed'+'.npy'
+    if fix_mode == 'copy':
+        xa = np.load(file)
+        target = None
+    elif fix_mode == 'memmap':
+        shutil.copyfile(file, fixed)
+        target = fixed
+    elif fix_mode == 'inplace':
+        target = file
+    else:
+        raise ValueError('Unknown fix_mode ' + str(fix_mode) + ", use 'copy', 'memmap' or 'inplace'")
+    if target is not None:
+        xa = np.load(target, mmap_mode='r+')
+    #
+    # Only the rows with NaNs need filling, the sample index of TC-extract_data.py lists them
+    #
+    indexfile = os.path.dirname(file) + '/' + os.path.basename(file).replace('CNNfeatures', 'CNNindex')
+    rows = range(len(xa))
+    if os.path.exists(indexfile):
+        index = np.load(indexfile)
+        if len(index) == len(xa):
+            rows = np.flatnonzero(index['nan_percent'] > 0)
+    rows = nan_rows(xa, rows)
     #print(xa.shape[1],flush=True)
     if xa.shape[1] == 5:
         fillmode = 0
     else:
         fillmode = 1
-    for i in range(len(xa)):
-        if np.isnan(np.sum(xa[i])):
-            for j in range(len(xa[i])//4):
-                xa[i,j*4:4*j+5] = fill_nan(xa[i,j*4:4*j+5])
+    if pool is None or target is None:
+        fill_rows(xa, rows, filler)
+        print('Fill plan cache: ' + filler.cache.stats(), flush=True)
+    else:
+        ntask = min(len(rows), max(nworkers, -(-len(rows) // batch_size)))
+        tasks = [(target, part) for part in np.array_split(rows, ntask)] if ntask > 0 else []
+        hits = misses = 0
+        for nfilled, task_hits, task_misses in pool.imap_unordered(fill_task, tasks):
+            hits += task_hits
+            misses += task_misses
+        print('Fill plan cache of the workers: ' + str(hits) + ' hits, ' + str(misses) + ' misses', flush=True)
+    print(str(len(rows)) + ' of ' + str(len(xa)) + ' samples filled', flush=True)
     #print(np.sum(np.isnan(xa)), flush=True)
-    np.save(file[:-4]+'fixed'+'.npy', xa)
+    if target is None:
+        np.save(fixed, xa)
+    else:
+        xa.flush()
+        del xa
+        if fix_mode == 'inplace':
+            os.replace(file, fixed)
+
+def check_channels(root, var_num, windows):
+    """
+    Check the channel layout written by TC-extract_data.py (CNNfeatures{var_num}_{windows}_channels.json)
+    against the layout fix_data relies on: var_num channels, in groups of four that start with U and V
+    at the same level, since the wind of each group guides the filling of the group.
+
+    Parameters:
+    - root: str
+        The directory of the features, searched recursively for the layout.
+    - var_num: int
+        The number of channels.
+    - windows: str
+        The window size, e.g. 19x19.
+
+    Returns:
+    - None
+    """
+    specfiles = glob.glob(root + '**/CNNfeatures' + str(var_num) + '_' + windows + '_channels.json', recursive=True)
+    if len(specfiles) == 0:
+        print('No channel layout found under ' + root + ', assuming U, V, T, RH per level.', flush=True)
+        return
+    with open(specfiles[0]) as f:
+        channels = json.load(f)['channels']
+    if len(channels) != var_num:
+        raise ValueError(specfiles[0] + ' has ' + str(len(channels)) + ' channels, var_num is ' + str(var_num))
+    for j in range(len(channels) // 4):
+        u, v = channels[4 * j], channels[4 * j + 1]
+        if u[0] != 'U' or v[0] != 'V' or u[1] != v[1]:
+            raise ValueError('Channels ' + str(4 * j) + ' and ' + str(4 * j + 1) + ' of ' + specfiles[0] + ' are '
+                             + str(u) + ' and ' + str(v) + ', fix_data needs U and V of the same level there.')
 #
 # MAIN CALL: 
 #
 windows = str(windowsize[0])+'x'+str(windowsize[1])
+check_channels(workdir+'/exp_'+str(var_num)+'features_'+windows+'/', var_num, windows)
+filler = make_filler(fill_method, plan_cache_size)   # shared by all the files, the storms recur across them
+# the workers fork after filler is made and keep their own copy across the files
+pool = multiprocessing.get_context('fork').Pool(nworkers) if nworkers > 1 and fix_mode != 'copy' else None
 root = workdir+'/exp_'+str(var_num)+'features_'+windows+'/monthly/'
 pattern = f'{root}**/CNNfeatures{var_num}_{windows}*.npy'
 
 # Find and process the files
-for file in glob.iglob(pattern, recursive=True):
+for file in glob.glob(pattern, recursive=True):
     print("Filling ", file)
     if 'fixed' in file:
         continue
-    fix_data(file)
+    fix_data(file, pool)
 print('Completed')
+if pool is not None:
+    pool.close()
+    pool.join()
@@ -6,6 +6,11 @@
 # HIST: - May 16, 2024: created by Khanh Luong
 #       - May 18, 2024: cross-checked and cleaned up by CK
 #
+# NOTE: The rows of each split are saved as train/test{var_num}rows_{windows}.npy, and the matching
+#       records of the sample index CNNindex{var_num}_{windows}.npy (see TC-extract_data.py) as
+#       train/test{var_num}meta_{windows}.npy, so that later steps can trace every sample back
+#       to its window.
+#
 # USAGE: edit the main call with proper paths and parameters before running this script
 #
 # AUTH: Khanh Luong (kmluong@iu.edu)
@@ -24,35 +29,22 @@ var_num = 13
 #####################################################################################
 # DO NOT EDIT BELOW UNLESS YOU WANT TO MODIFY THE SCRIPT
 #####################################################################################
-def split_data(features, labels, test_percentage=10):
+def split_rows(nsample, test_percentage=10):
     """
-    Shuffle and split the data into training and testing datasets.
+    Shuffle the rows of the data and split them into training and testing rows. The shuffle is
+    sklearn's shuffle with random_state=0, so the sets are the ones the data itself used to be
+    shuffled and split into.
 
     Parameters:
-    - features (numpy.ndarray): Array of input features.
-    - labels (numpy.ndarray): Array of corresponding labels.
+    - nsample (int): The number of samples.
     - test_percentage (int): Percentage of the data to be used as test set (default is 10).
 
     Returns:
-    - tuple: Tuple containing:
-        - train_features (numpy.ndarray): Features for the training set.
-        - train_labels (numpy.ndarray): Labels for the training set.
-        - test_features (numpy.ndarray): Features for the testing set.
-        - test_labels (numpy.ndarray): Labels for the testing set.
+    - tuple: (train_rows, test_rows), the rows of each set in the input arrays.
     """
-    # Shuffle the data
-    features, labels = shuffle(features, labels, random_state=0)
-
-    # Compute the split index
-    split_idx = int(len(features) * (test_percentage / 100))
-
-    # Split the data into training and testing sets
-    test_features = features[:split_idx]
-    test_labels = labels[:split_idx]
-    train_features = features[split_idx:]
-    train_labels = labels[split_idx:]
-
-    return train_features, train_labels, test_features, test_labels
+    rows = shuffle(np.arange(nsample), random_state=0)
+    split_idx = int(nsample * (test_percentage / 100))
+    return rows[split_idx:], rows[:split_idx]
 #
 # MAIN CALL: 
 #
@@ -64,12 +56,26 @@ if not os.path.exists(data_directory):
     print("Must have the input data by now....exit",data_directory)
     exit
 
-# Load the data
-features = np.load(data_directory + feature_file)
+index_file = 'CNNindex'+str(var_num)+'_'+windows+'.npy'
+
+# Load the data, the features are only read for the selected rows
+features = np.load(data_directory + feature_file, mmap_mode='r')
 labels = np.load(data_directory + label_file)
 
 # Split the data
-train_features, train_labels, test_features, test_labels = split_data(features, labels, test_percentage=split_ratio)
+train_rows, test_rows = split_rows(len(labels), test_percentage=split_ratio)
+train_features, test_features = features[train_rows], features[test_rows]
+train_labels, test_labels = labels[train_rows], labels[test_rows]
+np.save(data_directory + 'train'+str(var_num)+'rows_'+windows+'.npy', train_rows)
+np.save(data_directory + 'test'+str(var_num)+'rows_'+windows+'.npy', test_rows)
+if os.path.exists(data_directory + index_file):
+    index = np.load(data_directory + index_file)
+    if len(index) == len(labels):
+        np.save(data_directory + 'train'+str(var_num)+'meta_'+windows+'.npy', index[train_rows])
+        np.save(data_directory + 'test'+str(var_num)+'meta_'+windows+'.npy', index[test_rows])
+    else:
+        print(index_file + ' has ' + str(len(index)) + ' records for ' + str(len(labels)) + ' samples, '
+              + 'it is stale and no meta file is saved.', flush=True)
 
 # Save the split data
 np.save(data_directory + 'train'+str(var_num)+'x_'+windows+'.npy', train_features)
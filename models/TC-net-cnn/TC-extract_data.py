@@ -37,8 +37,11 @@ import os
 import matplotlib.pyplot as plt
 import numpy as np
 import glob
-from npy_append_array import NpyAppendArray
+from npy_append_array import NpyAppendArray, recover
 import math
+import json
+import zlib
+import multiprocessing
 #
 # Edit the input data path and parameters before running this script.
 # Note that all output will be stored under the same exp name.
@@ -46,22 +49,644 @@ import math
 inputpath='/N/project/Typhoon-deep-learning/output/TC_domain/'
 workdir='/N/project/Typhoon-deep-learning/output/'
 windowsize=[19,19]      # domain size (degree) centered on TC center
-var_num = 13            # number of channels for input
+#
+# Channels of the features, in order: (variable, level in mb), or (variable, None) for the surface
+# fields. The layout is written next to the arrays in CNNfeatures{var_num}_{windowsize}_channels.json.
+#
+channels = [('U', 850), ('V', 850), ('T', 850), ('RH', 850),
+            ('U', 950), ('V', 950), ('T', 950), ('RH', 950),
+            ('U', 750), ('V', 750), ('T', 750), ('RH', 750), ('SLP', None)]
+var_num = len(channels) # number of channels for input
 force_rewrite = True    # overwrite previous dataset option
+shard_index = int(os.environ.get('SLURM_ARRAY_TASK_ID', 0)) - int(os.environ.get('SLURM_ARRAY_TASK_MIN', 0))
+shard_count = int(os.environ.get('SLURM_ARRAY_TASK_COUNT', 1))  # tasks of a job array (sbatch --array=0-7)
+merge_count = int(os.environ.get('MERGE_SHARDS', 0))            # rerun with MERGE_SHARDS=8 to merge the 8 shards
+write_batch = 256       # samples buffered per output before appending them to the .npy file
+preallocate = False     # count the accepted samples first, then fill preallocated arrays in parallel
+nworkers = int(os.environ.get('SLURM_CPUS_PER_TASK', 1))  # processes filling the preallocated arrays, or dumping parts of the windows
+omit_percent = 5        # samples with more NaN (%) in the first 4 channels are dropped. The default wind-aware
+                        # filling of TC-CA_NaN_filling.py needs <= 5, its 'nearest' and 'laplace' methods allow more
 print('Initiation completed.', flush=True)
 
 #####################################################################################
 # DO NOT EDIT BELOW UNLESS YOU WANT TO MODIFY THE SCRIPT
 #####################################################################################
+index_dtype = [('window', 'U64'), ('tcname', 'U32'), ('basin', 'U2'), ('iso_time', 'U19'),
+               ('clat', 'f8'), ('clon', 'f8'), ('nan_percent', 'f4'),
+               ('vmax', 'f8'), ('pmin', 'f8'), ('rmw', 'f8')]   # one record per feature row, see window_record
+def shard_of(key, shard_count):
+    """
+    Assign a key to a shard with a hash that does not change between runs or machines, unlike hash().
+
+    Parameters:
+    - key (str): The key, e.g. the name of a window relative to TC_domain/.
+    - shard_count (int): The number of shards.
+
+    Returns:
+    - int: The shard of the key, in [0, shard_count).
+    """
+    return zlib.crc32(key.encode()) % shard_count
+
+def shard_suffix(shard_index, shard_count):
+    """
+    Build the suffix of the outputs of a shard, so that the shards of a job array never share a file.
+
+    Parameters:
+    - shard_index (int): The shard, in [0, shard_count).
+    - shard_count (int): The number of shards.
+
+    Returns:
+    - str: '' without sharding, else e.g. _shard3of8.
+    """
+    if shard_count <= 1:
+        return ''
+    return '_shard' + str(shard_index) + 'of' + str(shard_count)
+
+def iter_windows(root, windowsize, shard_index=0, shard_count=1):
+    """
+    Yield every TC window of a given size from the output of MERRA2tc_domain.py, either from the
+    consolidated store root/MERRA_TC{size}.nc (backend='store'), or from the stores of its shards,
+    or from the per-window NetCDF files. Samples of the stores invalidated by a later extraction of
+    their day are skipped.
+
+    Parameters:
+    - root (str): The root directory containing NetCDF files (TC_domain/).
+    - windowsize (list of floats): The size of the TC domain in degrees.
+    - shard_index (int): The shard of the windows to yield, in [0, shard_count).
+    - shard_count (int): The number of shards. If > 1, only the windows whose name relative to root
+                    is hashed to shard_index are yielded, see shard_of.
+
+    Returns:
+    - generator: (filename, data) of each window, sorted by window name whatever the backend and the
+                 order in which the file system lists the files, so that the serial, preallocated and
+                 parallel dumps (see merge_shards) write their rows in the same order. For the store,
+                 filename is the name the window would have in the TC_domain tree, and data carries
+                 the same attributes as a file.
+    """
+    id1 = str(windowsize[0]) + 'x' + str(windowsize[1])
+    storenames = [root + 'MERRA_TC' + id1 + '.nc']
+    if not os.path.isfile(storenames[0]):
+        storenames = sorted(glob.glob(root + 'MERRA_TC' + id1 + '_shard*.nc'))
+    if len(storenames) > 0:
+        meta = ['window_lat', 'window_lon', 'VMAX', 'PMIN', 'RMW', 'CLAT', 'CLON', 'TCNAME', 'BASIN', 'ISO_TIME', 'WINDOW', 'VALID']
+        stores = []
+        samples = []
+        for storename in storenames:
+            store = xr.open_dataset(storename)
+            store = store.isel(sample=slice(0, int(store.attrs['nsample'])))
+            names = store['WINDOW'].values
+            valid = store['VALID'].values == 1 if 'VALID' in store else np.ones(len(names), dtype=bool)
+            samples.extend((str(names[n]), len(stores), n) for n in range(store.sizes['sample'])
+                           if valid[n] and (shard_count <= 1 or shard_of(str(names[n]), shard_count) == shard_index))
+            stores.append(store)
+        for name, k, n in sorted(samples):
+            store = stores[k]
+            fields = [field for field in store.data_vars if field not in meta]
+            sample = store.isel(sample=n)
+            data = sample[fields].assign_coords(lat=sample['window_lat'].values, lon=sample['window_lon'].values)
+            data = data.assign_attrs({field: sample[field].values.item() for field in meta[2:8]})
+            yield root + name, data
+        return
+    for filename in sorted(glob.glob(root + '*/**/*.nc', recursive=True)):
+        if id1 in filename and (shard_count <= 1 or shard_of(filename[len(root):], shard_count) == shard_index):
+            yield filename, xr.open_dataset(filename)
+
+def merge_shards(outdir, outname, shard_count, parts=None, suffix=''):
+    """
+    Merge the arrays written by the shards of a job array into the canonical arrays. The samples are
+    sorted by window name, so that the result depends neither on the number of shards nor on the order
+    in which the file system lists the windows.
+
+    Parameters:
+    - outdir (str): The output directory of the NumPy arrays.
+    - outname (list): List containing the output names, as for dumping_data.
+    - shard_count (int): The number of shards of the job array.
+    - parts (list of int): The shards to merge, all of them by default.
+    - suffix (str): The suffix of the merged arrays. If not empty, the window names of the merged
+                    arrays are also written to outname[0]{suffix}.json, so that they can be merged
+                    again, see parallel_dumping.
+
+    Returns:
+    None
+    """
+    merged_suffix = suffix
+    rows = {}
+    for shard_index in range(shard_count) if parts is None else parts:
+        suffix = shard_suffix(shard_index, shard_count)
+        try:
+            with open(outdir + outname[0] + suffix + '.json') as f:
+                keys = json.load(f)
+        except OSError:
+            raise FileNotFoundError('Shard ' + str(shard_index) + ' of ' + str(shard_count) + ' has not finished, no '
+                                    + outdir + outname[0] + suffix + '.json')
+        for addon, names in keys.items():
+            rows.setdefault(addon, []).extend((name, suffix, position) for position, name in enumerate(names))
+    for addon in sorted(rows):
+        addon_rows = sorted(rows[addon])
+        for name in outname:
+            shards = {}
+            for suffix in set(row[1] for row in addon_rows):
+                shards[suffix] = np.load(outdir + name + suffix + addon + '.npy', mmap_mode='r')
+            first = next(iter(shards.values()))
+            merged = np.lib.format.open_memmap(outdir + name + merged_suffix + addon + '.npy', mode='w+', dtype=first.dtype,
+                                               shape=(len(addon_rows),) + first.shape[1:])
+            for n, (key, suffix, position) in enumerate(addon_rows):
+                merged[n] = shards[suffix][position]
+            merged.flush()
+            del merged
+        print('Merged ' + str(len(addon_rows)) + ' samples of ' + outname[0] + merged_suffix + addon + ' from '
+              + str(shard_count if parts is None else len(parts)) + ' shards.', flush=True)
+    if merged_suffix:
+        with open(outdir + outname[0] + merged_suffix + '.json', 'w') as f:
+            json.dump({addon: sorted(row[0] for row in rows[addon]) for addon in rows}, f)
+
+def committed_rows(filename):
+    """
+    Count the samples of a .npy output that were committed, i.e. counted by its header and fully
+    on disk (see BatchWriter.flush). Samples written after the last header update are not counted.
+
+    Parameters:
+    - filename (str): The output.
+
+    Returns:
+    - int: The number of committed samples, 0 if the header cannot be read.
+    """
+    try:
+        array = np.load(filename, mmap_mode='r')
+    except (OSError, ValueError):
+        return 0
+    if array.ndim == 0 or array.shape[0] == 0:
+        return 0
+    rowbytes = array[0].nbytes
+    return min(array.shape[0], (os.path.getsize(filename) - array.offset) // rowbytes)
+
+def truncate_rows(filename, count):
+    """
+    Cut a .npy output back to its first count samples, dropping the bytes written after them and
+    rewriting the header with npy_append_array.recover. The output is deleted if count is 0.
+
+    Parameters:
+    - filename (str): The output.
+    - count (int): The number of samples kept, at most committed_rows(filename).
+
+    Returns:
+    None
+    """
+    if count == 0:
+        os.remove(filename)
+        return
+    array = np.load(filename, mmap_mode='r')
+    end = array.offset + count * array[0].nbytes
+    del array
+    os.truncate(filename, end)
+    recover(filename)
+
+def recover_outputs(outdir, outname, suffix=''):
+    """
+    Bring the outputs of a previous, possibly interrupted, run back to a consistent state before
+    appending to them. The outputs of a group (features, labels, ...) are flushed one after the
+    other, so a crash can leave them with different numbers of committed samples: all of them are
+    cut back to the samples every one of them committed, and to the window names listed for the
+    group in outname[0]{suffix}.json when this key list exists.
+
+    Parameters:
+    - outdir (str): The output directory of the NumPy arrays.
+    - outname (list): List containing the output names, as for dumping_data.
+    - suffix (str): The shard suffix of the outputs, see shard_suffix.
+
+    Returns:
+    - dict: The key list of each group, cut back like the outputs, or {} without key list.
+    """
+    keyfile = outdir + outname[0] + suffix + '.json'
+    keys = None
+    if os.path.exists(keyfile):
+        with open(keyfile) as f:
+            keys = json.load(f)
+    groups = set()
+    for name in outname:
+        for filename in glob.glob(outdir + name + suffix + '*.npy'):
+            group = filename[len(outdir + name + suffix):-4]
+            if suffix or not group.startswith('_shard'):
+                groups.add(group)
+    for group in sorted(groups):
+        filenames = [outdir + name + suffix + group + '.npy' for name in outname]
+        count = min(committed_rows(filename) if os.path.exists(filename) else 0 for filename in filenames)
+        if keys is not None:
+            count = min(count, len(keys.get(group, [])))
+            keys[group] = keys.get(group, [])[:count]
+        for filename in filenames:
+            if os.path.exists(filename):
+                truncate_rows(filename, count)
+        if count > 0:
+            print('Kept ' + str(count) + ' committed samples of ' + outname[0] + suffix + group + '.', flush=True)
+    return keys or {}
+
+class BatchWriter:
+    """
+    Buffer the samples of dumping_data in memory and append them to the .npy outputs in batches,
+    instead of opening each output and rewriting its header for every sample. The data of a batch
+    is written and synced before the header is updated, so that after a crash the header of each
+    output still counts its committed samples only; the bytes of an unfinished batch are cut off
+    when the output is opened again (see truncate_rows). The outputs of a group can still differ
+    by a batch, see recover_outputs.
+
+    Parameters:
+    - batch_size (int): The number of samples buffered per output before they are written.
+    - delete_if_exists (bool): Whether to delete the outputs the first time they are opened.
+    """
+    def __init__(self, batch_size=256, delete_if_exists=False):
+        self.batch_size = max(1, batch_size)
+        self.delete_if_exists = delete_if_exists
+        self.buffers = {}
+        self.outputs = {}
+
+    def append(self, filename, array):
+        """
+        Buffer the samples of array (first axis) for the output filename.
+        """
+        buffer = self.buffers.setdefault(filename, [])
+        buffer.append(array)
+        if len(buffer) >= self.batch_size:
+            self.flush(filename)
+
+    def open(self, filename):
+        if filename not in self.outputs:
+            if os.path.exists(filename) and not self.delete_if_exists:
+                truncate_rows(filename, committed_rows(filename))
+            self.outputs[filename] = NpyAppendArray(filename, delete_if_exists=self.delete_if_exists,
+                                                    rewrite_header_on_append=False)
+        return self.outputs[filename]
+
+    def flush(self, filename=None):
+        """
+        Write the buffered samples of filename, or of all the outputs if filename is None.
+        """
+        for name in list(self.buffers) if filename is None else [filename]:
+            buffer = self.buffers.pop(name, [])
+            if len(buffer) == 0:
+                continue
+            output = self.open(name)
+            new_file = output.fp is None
+            output.append(np.concatenate(buffer))
+            if not new_file:
+                output.fp.flush()
+                os.fsync(output.fp.fileno())
+                output.update_header()
+                output.fp.flush()
+
+    def close(self):
+        self.flush()
+        for output in self.outputs.values():
+            output.close()
+        self.outputs = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+def channel_list(channels=None):
+    """
+    Resolve a channel specification.
+
+    Parameters:
+    - channels (list): (variable, level) of each channel, with level in mb, or None for the surface
+                    fields such as SLP. None stands for the 13 channels U, V, T, RH at 850, 950 and
+                    750mb, then SLP.
+
+    Returns:
+    - list: The (variable, level) of each channel.
+    """
+    if channels is None:
+        return [(name, level) for level in (850, 950, 750) for name in ('U', 'V', 'T', 'RH')] + [('SLP', None)]
+    return [(name, level) for name, level in channels]
+
+def channel_array(data, channels=None):
+    """
+    Select the channels of a window into one preallocated block. All the upper-level channels are
+    selected with a single .sel over the variables and levels of the specification, instead of one
+    selection per level glued with np.append.
+
+    Parameters:
+    - data (xarray.Dataset): The window.
+    - channels (list): The channel specification, see channel_list.
+
+    Returns:
+    - numpy array: The channels, of shape (1, number of channels, lat, lon).
+    """
+    channels = channel_list(channels)
+    upper = [n for n, (name, level) in enumerate(channels) if level is not None]
+    names = list(dict.fromkeys(channels[n][0] for n in upper))
+    levels = list(dict.fromkeys(channels[n][1] for n in upper))
+    dtype = np.result_type(*[data[name].dtype for name in dict.fromkeys(name for name, level in channels)])
+    block = np.empty((1, len(channels), data.sizes['lat'], data.sizes['lon']), dtype=dtype)
+    if len(upper) > 0:
+        fields = data[names].sel(lev=levels).to_array().transpose('variable', 'lev', 'lat', 'lon').values
+        block[0, upper] = fields[[names.index(channels[n][0]) for n in upper], [levels.index(channels[n][1]) for n in upper]]
+    for n, (name, level) in enumerate(channels):
+        if level is None:
+            block[0, n] = data[name].transpose('lat', 'lon').values
+    return block
+
+def write_channel_spec(outdir, outname, channels=None, windowsize=[18,18]):
+    """
+    Write the channel layout of the dataset next to its arrays, as outname[0]_channels.json, so that
+    the next steps can check it instead of hardcoding var_num and the channel order. The file is
+    replaced atomically, since the shards of a job array all write it.
+
+    Parameters:
+    - outdir (str): The output directory of the NumPy arrays.
+    - outname (list): List containing the output names, as for dumping_data.
+    - channels (list): The channel specification, see channel_list.
+    - windowsize (list of floats): The size of the TC domain in degrees.
+
+    Returns:
+    None
+    """
+    channels = channel_list(channels)
+    spec = {'channels': [[name, level] for name, level in channels], 'var_num': len(channels),
+            'windowsize': list(windowsize), 'outputs': list(outname), 'labels': ['VMAX', 'PMIN', 'RMW']}
+    filename = outdir + outname[0] + '_channels.json'
+    tmpname = filename + '.' + str(os.getpid()) + '.tmp'
+    with open(tmpname, 'w') as f:
+        json.dump(spec, f)
+    os.replace(tmpname, filename)
+
+def window_record(root, filename, data, windowsize=[18,18], features=None):
+    """
+    Build the sample index record of one window: its name relative to root, storm name, basin,
+    ISO time, center, NaN percentage of its features before the NaN filling, and labels. The
+    records are written in the same order as the feature rows, so that each row keeps a stable
+    identity through the NaN filling, the split and the evaluation.
+
+    Parameters:
+    - root (str): The root directory containing NetCDF files.
+    - filename (str): The name of the window, as yielded by iter_windows.
+    - data (xarray.Dataset): The window.
+    - windowsize (list of floats): The size of the TC domain in degrees.
+    - features (numpy array): The features of the window, for the NaN percentage.
+
+    Returns:
+    - numpy structured array: One record of dtype index_dtype.
+    """
+    key = filename[len(root):]
+    id1 = (str(windowsize[0]) + 'x' + str(windowsize[1]))
+    position = key.find(id1) + len(id1)
+    date = key[position:position + 10]  # YYYYMMDDHH
+    record = np.zeros(1, dtype=index_dtype)
+    record['window'] = key
+    record['tcname'] = str(data.attrs.get('TCNAME', ''))
+    record['basin'] = key[0:2]
+    record['iso_time'] = date[0:4] + '-' + date[4:6] + '-' + date[6:8] + ' ' + date[8:10] + ':00:00'
+    record['clat'] = data.CLAT
+    record['clon'] = data.CLON
+    record['nan_percent'] = 100 * np.mean(np.isnan(features)) if features is not None else np.nan
+    record['vmax'] = data.VMAX
+    record['pmin'] = data.PMIN
+    record['rmw'] = data.RMW
+    return record
+
+def window_group(root, filename, regionize=True):
+    """
+    Find the output group of a window from its name.
+
+    Parameters:
+    - root (str): The root directory containing NetCDF files.
+    - filename (str): The name of the window, as yielded by iter_windows.
+    - regionize (bool): If True, the outputs are split by basin.
+
+    Returns:
+    - str: The basin if regionize, else ''.
+    """
+    if regionize:
+        return filename[len(root):len(root)+2]
+    return ''
+
+def window_arrays(root, filename, data, regionize=True, channels=None, windowsize=[18,18]):
+    """
+    Build the arrays of one window as they are written by dumping_data.
+
+    Parameters:
+    - root (str): The root directory containing NetCDF files.
+    - filename (str): The name of the window, as yielded by iter_windows.
+    - data (xarray.Dataset): The window.
+    - regionize (bool): If True, the outputs are split by basin.
+    - channels (list): The channel specification of the features, see channel_list.
+    - windowsize (list of floats): The size of the TC domain in degrees.
+
+    Returns:
+    - tuple: (addon, [features, labels, index]), with addon the suffix of the outputs of the window
+             and a leading sample axis of length 1 on each array.
+    """
+    #
+    # Choosing bands and level, data is taken from raw MERRA2 dataset, so the choice is not limited to atm level.
+    #
+    data_array_x = channel_array(data, channels)
+    data_array_y = np.array([data.VMAX, data.PMIN, data.RMW])  # knots, mb, nmile
+    data_array_y = data_array_y.reshape([1, data_array_y.shape[0]])
+    record = window_record(root, filename, data, windowsize, data_array_x)
+    return window_group(root, filename, regionize), [data_array_x, data_array_y, record]
+
+def band_nans(data, channels=None):
+    """
+    Count the NaNs of the first four channels of a window (the 850mb U, V, T, RH band by default),
+    the band checked against omit_percent by dumping_data. Only this band is read, so that the
+    counting pass of preallocate_data is cheap.
+
+    Parameters:
+    - data (xarray.Dataset): The window.
+    - channels (list): The channel specification of the features, see channel_list.
+
+    Returns:
+    - tuple: (number of NaNs in the band, number of grid points of one variable)
+    """
+    band = channel_array(data, channel_list(channels)[0:4])[0]
+    return int(np.sum(np.isnan(band))), math.prod(band[0].shape)
+
+def fill_task(task):
+    """
+    Fill the rows of the preallocated arrays for one worker of preallocate_data. The worker reads
+    only its own part of the windows, split with shard_of like the shards of a job array.
+
+    Parameters:
+    - task (tuple): (root, outdir, outname, suffix, regionize, windowsize, channels, rows, part_index,
+                    part_count),
+                    with rows mapping the name of each accepted window to its (group, row).
+
+    Returns:
+    - int: The number of rows filled.
+    """
+    root, outdir, outname, suffix, regionize, windowsize, channels, rows, part_index, part_count = task
+    outputs = {}
+    filled = 0
+    for filename, data in iter_windows(root, windowsize, part_index, part_count):
+        key = filename[len(root):]
+        if key not in rows:
+            continue
+        group, row = rows[key]
+        if group not in outputs:
+            outputs[group] = [np.load(outdir + name + suffix + group + '.npy', mmap_mode='r+') for name in outname]
+        for output, array in zip(outputs[group], window_arrays(root, filename, data, regionize, channels, windowsize)[1]):
+            output[row] = array[0]
+        filled += 1
+    for group in outputs.values():
+        for output in group:
+            output.flush()
+    return filled
+
+def check_rewrite(outdir, outname, suffix, cold_start):
+    """
+    Refuse to run a mode that always rewrites its outputs (preallocate_data, parallel_dumping) on
+    existing outputs without cold_start, which dumping_data would append to instead.
+
+    Parameters:
+    - outdir (str): The output directory of the NumPy arrays.
+    - outname (list): List containing the output names, as for dumping_data.
+    - suffix (str): The shard suffix of the outputs, see shard_suffix.
+    - cold_start (bool): Whether the outputs are to be rewritten.
+
+    Returns:
+    None
+    """
+    if cold_start:
+        return
+    existing = [filename for name in outname for filename in glob.glob(outdir + name + suffix + '*.npy')
+                if suffix or '_shard' not in filename[len(outdir + name):]]
+    if len(existing) > 0:
+        raise ValueError('The preallocated and parallel dumps rewrite their outputs and cannot append to '
+                         + existing[0] + ', run with cold_start=True, or with nworkers=1 and preallocate=False.')
+
+def preallocate_data(root='', outdir='', outname=['features', 'labels'], regionize=True, omit_percent=5,
+                     windowsize=[18,18], cold_start=True, shard_index=0, shard_count=1, nworkers=1, channels=None):
+    """
+    Two-pass variant of dumping_data. A first pass reads only the 850mb band of each window to count
+    the accepted samples of each output, the arrays are then preallocated with their exact size, and
+    nworkers processes fill them by row, without any append. The rows are in the order of the first
+    pass, sorted by window name (see iter_windows), so the arrays are the same as the ones
+    dumping_data appends. The outputs are always rewritten, so existing ones are refused without
+    cold_start (see check_rewrite).
+
+    Parameters:
+    - root, outdir, outname, regionize, omit_percent, windowsize, cold_start, shard_index, shard_count,
+      channels: see dumping_data.
+    - nworkers (int): The number of processes filling the arrays.
+
+    Returns:
+    None
+    """
+    i = 0
+    omit = 0
+    suffix = shard_suffix(shard_index, shard_count)
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+    check_rewrite(outdir, outname, suffix, cold_start)
+    rows = {}
+    groups = {}
+    for filename, data in iter_windows(root, windowsize, shard_index, shard_count):
+        i += 1
+        nnan, npoint = band_nans(data, channels)
+        if nnan / 4 > omit_percent / 100 * npoint:
+            omit += 1
+            continue
+        if i % 1000 == 0:
+            print(str(i) + ' dataset counted.', flush=True)
+        group = window_group(root, filename, regionize)
+        if group not in groups:
+            arrays = window_arrays(root, filename, data, regionize, channels, windowsize)[1]
+            groups[group] = [0, [(array.shape[1:], array.dtype) for array in arrays]]
+        rows[filename[len(root):]] = (group, groups[group][0])
+        groups[group][0] += 1
+    print('Counted ' + str(len(rows)) + ' samples in ' + str(len(groups)) + ' outputs, '
+          + str(omit) + ' omitted due to NaNs.', flush=True)
+    for group, (count, layouts) in groups.items():
+        for name, (shape, dtype) in zip(outname, layouts):
+            output = np.lib.format.open_memmap(outdir + name + suffix + group + '.npy', mode='w+',
+                                               dtype=dtype, shape=(count,) + shape)
+            del output
+    part_count = shard_count * max(1, nworkers)
+    tasks = [(root, outdir, outname, suffix, regionize, windowsize, channels, rows, shard_index + shard_count * worker, part_count)
+             for worker in range(max(1, nworkers))]
+    if nworkers > 1:
+        with multiprocessing.get_context('fork').Pool(nworkers) as pool:
+            filled = sum(pool.imap_unordered(fill_task, tasks))
+    else:
+        filled = sum(map(fill_task, tasks))
+    if filled != len(rows):
+        raise RuntimeError('Filled ' + str(filled) + ' of ' + str(len(rows)) + ' preallocated samples, '
+                           + 'the windows changed between the two passes.')
+    if shard_count > 1:
+        keys = {}
+        for key, (group, row) in rows.items():
+            keys.setdefault(group, []).append(key)
+        with open(outdir + outname[0] + suffix + '.json', 'w') as f:
+            json.dump(keys, f)
+    print('Total ' + str(i) + ' dataset processed.', flush=True)
+    print('With ' + str(omit) + ' dataset omitted due to NaNs.', flush=True)
+
+def dump_task(task):
+    """
+    Pool task running dumping_data on one part of the windows, see parallel_dumping.
+
+    Parameters:
+    - task (dict): The arguments of dumping_data.
+
+    Returns:
+    - int: The part dumped.
+    """
+    dumping_data(**task)
+    return task['shard_index']
+
+def parallel_dumping(root='', outdir='', outname=['features', 'labels'], regionize=True, omit_percent=5,
+                     windowsize=[18,18], cold_start=False, shard_index=0, shard_count=1, batch_size=256, nworkers=2,
+                     channels=None):
+    """
+    Process-pool variant of dumping_data. The windows are split with shard_of into nworkers disjoint
+    parts, each worker dumps its part to local shards, and the shards are merged into the outputs of
+    this run with merge_shards, then deleted. The samples of the outputs are thus sorted by window
+    name, whatever the number of workers and the order in which the file system lists the windows,
+    so the splits and folds made from them are reproducible. The outputs are always rewritten, so
+    existing ones are refused without cold_start (see check_rewrite).
+
+    Parameters:
+    - root, outdir, outname, regionize, omit_percent, windowsize, cold_start, shard_index, shard_count,
+      batch_size, channels: see dumping_data. Inside a shard of a job array, the worker parts are the shards
+      shard_index + shard_count * worker of shard_count * nworkers.
+    - nworkers (int): The number of worker processes.
+
+    Returns:
+    None
+    """
+    check_rewrite(outdir, outname, shard_suffix(shard_index, shard_count), cold_start)
+    part_count = shard_count * nworkers
+    parts = [shard_index + shard_count * worker for worker in range(nworkers)]
+    tasks = [dict(root=root, outdir=outdir, outname=outname, regionize=regionize, omit_percent=omit_percent,
+                  windowsize=windowsize, cold_start=True, shard_index=part, shard_count=part_count,
+                  batch_size=batch_size, channels=channels) for part in parts]
+    with multiprocessing.get_context('fork').Pool(nworkers) as pool:
+        for part in pool.imap_unordered(dump_task, tasks):
+            print('Worker part ' + str(part) + ' of ' + str(part_count) + ' dumped.', flush=True)
+    merge_shards(outdir, outname, part_count, parts=parts, suffix=shard_suffix(shard_index, shard_count))
+    for part in parts:
+        suffix = shard_suffix(part, part_count)
+        with open(outdir + outname[0] + suffix + '.json') as f:
+            groups = list(json.load(f))
+        for group in groups:
+            for name in outname:
+                os.remove(outdir + name + suffix + group + '.npy')
+        os.remove(outdir + outname[0] + suffix + '.json')
+
 def dumping_data(root='', outdir='', outname=['features', 'labels'],
-                 regionize=True, omit_percent=5, windowsize=[18,18], cold_start=False):
+                 regionize=True, omit_percent=5, windowsize=[18,18], cold_start=False,
+                 shard_index=0, shard_count=1, batch_size=256, preallocate=False, nworkers=1, channels=None):
     """
     Select and convert data from NetCDF files to NumPy arrays.
 
     Parameters:
     - root (str): The root directory containing NetCDF files.
     - outdir (str): The output directory for the NumPy arrays.
-    - outname (list): List containing the output names for features and labels.
+    - outname (list): List containing the output names for features, labels and, optionally, the
+                    sample index (see window_record).
     - regionize (bool): if True, output data for each basin separately, 
                     with output files named outname{basin}.npy
     - omit_percent (float, percentage): Defines the upper limit of acceptable NaN (missing data due 
@@ -69,6 +694,20 @@ def dumping_data(root='', outdir='', outname=['features', 'labels'],
     - windowsize (list of floats): Specifies the size of the rectangular domain for Tropical Cyclone 
                     data extraction in degrees. The function selects a domain with dimensions closest 
                     to, but not smaller than, the specified window size.
+    - shard_index (int): The shard of the windows processed by this run, in [0, shard_count).
+    - shard_count (int): The number of shards, e.g. the number of tasks of a job array. If > 1, the
+                    outputs are named outname{_shardXofN}{group}.npy, and the window names of each
+                    output are written to outname[0]{_shardXofN}.json for merge_shards.
+    - batch_size (int): The number of samples buffered per output before they are appended to the
+                    file, see BatchWriter.
+    - preallocate (bool): If True, count the samples first and fill preallocated arrays by row with
+                    nworkers processes instead of appending, see preallocate_data. The outputs are
+                    then always rewritten, and existing ones require cold_start=True.
+    - nworkers (int): The number of processes filling the preallocated arrays, or, without preallocate,
+                    the number of processes dumping disjoint parts of the windows, see parallel_dumping.
+                    With nworkers > 1 the outputs are always rewritten, as with preallocate.
+    - channels (list): The (variable, level) of each channel of the features, see channel_list. The
+                    layout is written to outname[0]_channels.json, see write_channel_spec.
 
     Returns:
     None
@@ -78,6 +717,8 @@ def dumping_data(root='', outdir='', outname=['features', 'labels'],
     #
     i = 0
     omit = 0
+    suffix = shard_suffix(shard_index, shard_count)
+    keys = {}
     if not os.path.exists(outdir):
         os.makedirs(outdir)
     #
@@ -85,33 +726,33 @@ def dumping_data(root='', outdir='', outname=['features', 'labels'],
     # Note: This script processes files with the domain size specified in the `windowsize` parameter.
     #       Domains should be pre-processed using the MERRA2TC_domain.py script to set the desired windowsize.
     #
-    for filename in glob.iglob(root + '*/**/*.nc', recursive=True):
-        if (str(windowsize[0])+'x'+str(windowsize[1])) in filename:
-          pass
-        else:
-          continue
-        data = xr.open_dataset(filename)
-        #    
-        # Choosing bands and level, data is taken from raw MERRA2 dataset, so the choice is not limited to atm level.
-        #
-        data_array_x = np.array(data[['U', 'V', 'T', 'RH']].sel(lev=850).to_array())
-        data_array_x = np.append(data_array_x, np.array(data[['U', 'V', 'T', 'RH']].sel(lev=950).to_array()), axis=0)
-        data_array_x = np.append(data_array_x, np.array(data[['U', 'V', 'T', 'RH', 'SLP']].sel(lev=750).to_array()), axis=0)
+    write_channel_spec(outdir, outname, channels, windowsize)
+    if preallocate:
+        preallocate_data(root=root, outdir=outdir, outname=outname, regionize=regionize, omit_percent=omit_percent,
+                         windowsize=windowsize, cold_start=cold_start, shard_index=shard_index, shard_count=shard_count,
+                         nworkers=nworkers, channels=channels)
+        return
+    if nworkers > 1:
+        parallel_dumping(root=root, outdir=outdir, outname=outname, regionize=regionize, omit_percent=omit_percent,
+                         windowsize=windowsize, cold_start=cold_start, shard_index=shard_index, shard_count=shard_count,
+                         batch_size=batch_size, nworkers=nworkers, channels=channels)
+        return
+    if not cold_start:
+        keys = recover_outputs(outdir, outname, suffix)
+    writer = BatchWriter(batch_size, delete_if_exists=cold_start)
+    for filename, data in iter_windows(root, windowsize, shard_index, shard_count):
+        addon, arrays = window_arrays(root, filename, data, regionize, channels, windowsize)
+        data_array_x = arrays[0]
         #
-        # Check for NaN percentage within the first level (which is 850mb), set up for a cold start
+        # Check for NaN percentage within the first level (which is 850mb)
         #
-        delete_if_exists = False
-        if cold_start and i == 0:
-            delete_if_exists = True
-        else:
-            delete_if_exists = False
-        if np.sum(np.isnan(data_array_x[0:4])) / 4 > omit_percent / 100 * math.prod(data_array_x[0].shape):
+        if np.sum(np.isnan(data_array_x[0, 0:4])) / 4 > omit_percent / 100 * math.prod(data_array_x[0, 0].shape):
             #print(data_array_x[0].shape, np.sum(np.isnan(data_array_x[0:4])), 
             #      np.sum(np.isnan(data_array_x[0][12:51,10:41])), flush=True)
             i+=1
             #print(filename + ' omitted', flush=True)
             omit+=1
-            if np.sum(np.isnan(data_array_x[0:4])) % 4 != 0:
+            if np.sum(np.isnan(data_array_x[0, 0:4])) % 4 != 0:
                 #
                 # Assuming all variables share the same NaN locations, this line ensures that.
                 # This script is unusable if the line show up in the terminal.
@@ -122,26 +763,20 @@ def dumping_data(root='', outdir='', outname=['features', 'labels'],
                 print(str(i) + ' dataset processed.', flush=True)
             continue
         #
-        # Appending data directly to numpy savefile
+        # Appending data to the numpy savefiles, in batches of batch_size samples
         #
-        data_array_x = data_array_x.reshape([1, data_array_x.shape[0],
-                                             data_array_x.shape[1], data_array_x.shape[2]])
-        data_array_y = np.array([data.VMAX, data.PMIN, data.RMW])  # knots, mb, nmile
-        data_array_y = data_array_y.reshape([1, data_array_y.shape[0]])
-        if regionize:
-            addon = filename[len(root):len(root)+2]
-        else:
-            addon = ''
-        with NpyAppendArray(outdir + outname[0] + addon + '.npy', delete_if_exists=delete_if_exists) as npaax:
-            npaax.append(data_array_x)
-
-        with NpyAppendArray(outdir + outname[1] + addon + '.npy', delete_if_exists=delete_if_exists) as npaay:
-            npaay.append(data_array_y)
+        for name, array in zip(outname, arrays):
+            writer.append(outdir + name + suffix + addon + '.npy', array)
+        keys.setdefault(addon, []).append(filename[len(root):])
 
         i += 1
         if i % 1000 == 0:
             print(str(i) + ' dataset processed.', flush=True)
             print(str(omit) + ' dataset omitted due to NaNs.', flush = True)
+    writer.close()
+    if shard_count > 1:
+        with open(outdir + outname[0] + suffix + '.json', 'w') as f:
+            json.dump(keys, f)
     print('Total ' + str(i) + ' dataset processed.', flush=True)
     print('With ' + str(omit) + ' dataset omitted due to NaNs.', flush = True)
 #
@@ -166,13 +801,19 @@ except:
     second_check = False
 
 
-if second_check:
+if second_check and shard_count == 1 and merge_count == 0:  # the shards of a job array fill the directory together
     if force_rewrite:
         print('Force rewrite is True, rewriting the whole dataset.', flush = True)
     else:
         print('Will use the processed dataset, terminating this step.', flush = True)
         exit()    
 outname=['CNNfeatures'+str(var_num)+'_'+str(windowsize[0])+'x'+str(windowsize[1]),
-         'CNNlabels'+str(var_num)+'_'+str(windowsize[0])+'x'+str(windowsize[1])]
-dumping_data(root=inputpath, outdir=outputpath, windowsize=windowsize, 
-             outname=outname, regionize=False, cold_start = force_rewrite)
+         'CNNlabels'+str(var_num)+'_'+str(windowsize[0])+'x'+str(windowsize[1]),
+         'CNNindex'+str(var_num)+'_'+str(windowsize[0])+'x'+str(windowsize[1])]
+if merge_count > 1:
+    merge_shards(outputpath, outname, merge_count)
+else:
+    dumping_data(root=inputpath, outdir=outputpath, windowsize=windowsize,
+                 outname=outname, regionize=False, cold_start = force_rewrite,
+                 shard_index=shard_index, shard_count=shard_count, batch_size=write_batch,
+                 preallocate=preallocate, nworkers=nworkers, channels=channels, omit_percent=omit_percent)
@@ -65,11 +65,17 @@ for file in os.listdir(data_directory):
         feature_file = file
         label_file = file.replace('features', 'labels').replace('fixed.npy', '.npy')
         spacetimefile = file.replace('features', 'space_time_info').replace('fixed.npy', '.npy')
+        indexfile = file.replace('features', 'index').replace('fixed.npy', '.npy')  # sample index, see TC-extract_data_TSU.py
 
         # Load the data
         features = np.load(data_directory + feature_file)
         labels = np.load(data_directory + label_file)
         spacetime = np.load(data_directory + spacetimefile)
+        index = np.load(data_directory + indexfile) if os.path.exists(data_directory + indexfile) else None
+        if index is not None and len(index) != len(labels):
+            print(indexfile + ' has ' + str(len(index)) + ' records for ' + str(len(labels)) + ' samples, '
+                  + 'it is stale and no meta file is saved.', flush=True)
+            index = None
 
         # Initialize lists to hold concatenated training data
         all_train_features = []
@@ -93,4 +99,7 @@ for file in os.listdir(data_directory):
             np.save(data_directory + f'test_features_fold{fold}_{base_name}', test_features)
             np.save(data_directory + f'test_labels_fold{fold}_{base_name}', test_labels)
             np.save(data_directory + f'test_spacetime_fold{fold}_{base_name}', test_spacetime)
+            np.save(data_directory + f'test_rows_fold{fold}_{base_name}', test_index)
+            if index is not None:
+                np.save(data_directory + f'test_meta_fold{fold}_{base_name}', index[test_index])
             fold += 1
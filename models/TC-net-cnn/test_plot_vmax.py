@@ -153,4 +153,17 @@ axs[1].legend(custom_lines, [ 'MAE Area', f'RMSE: {rmse:.2f}', f'MAE: {mae:.2f}'
 plt.savefig(directory + '/fig_' + str(name) + '.png')
 print(f'Saved the result as Model:{name}.png')
 print('RMSE = ' + str("{:.2f}".format(datadict[name + 'rmse'])) + ' and MAE = ' + str("{:.2f}".format(datadict[name + 'MAE'])))
+#
+# Per-sample results, with the sample index of the test set written by TC-Split.py
+#
+meta_path = directory + '/' + os.path.basename(fea_path).replace('x_', 'meta_', 1)
+if os.path.exists(meta_path):
+    meta = np.load(meta_path)
+    predicted = datadict[name].reshape(-1)
+    np.savez(directory + '/result_' + str(name) + '.npz', window=meta['window'], tcname=meta['tcname'],
+             basin=meta['basin'], iso_time=meta['iso_time'], truth=y, predict=predicted)
+    for basin in np.unique(meta['basin']):
+        rows = meta['basin'] == basin
+        print(basin + ': MAE = ' + str("{:.2f}".format(np.mean(np.abs(predicted[rows] - y[rows]))))
+              + ' over ' + str(np.sum(rows)) + ' samples')
 print('Completed!')
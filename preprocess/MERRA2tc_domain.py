@@ -10,12 +10,28 @@
 #
 #====================================================================================
 import os
+import re
+import glob
+import json
+import zlib
+import queue
+import threading
+import collections
+import multiprocessing
+import concurrent.futures
 import pandas as pd
 import numpy as np
 import xarray as xr            #use xarray because it is far more better than netCDF4 
+import netCDF4 as nc           #only used to append windows to the consolidated store
+from npy_append_array import NpyAppendArray
 from datetime import datetime  #Use datetime to name the output files
 from timeit import default_timer as timer
 
+index_dtype = [('window', 'U64'), ('tcname', 'U32'), ('basin', 'U2'), ('iso_time', 'U19'),
+               ('clat', 'f8'), ('clon', 'f8'), ('nan_percent', 'f4'),
+               ('vmax', 'f8'), ('pmin', 'f8'), ('rmw', 'f8')]   # sample index of the stream backend, as in TC-extract_data.py
+netcdf_lock = threading.Lock()  #netCDF-C/HDF5 is not thread-safe, the reader and writer threads take turns
+
 #####################################
 def process_entries(per):
     """
@@ -246,11 +262,1702 @@ def trim_rmw_range(df, maxrmw, minrmw):
 #########################################
 
 
+def build_besttrack_cache(csvdataset, cachefile):
+    """
+    Convert the IBTrACS CSV into a typed columnar cache, stored as a NumPy record file that is
+    memory-mapped by later runs. Only entries whose max wind speed, min pressure and RMW are numbers
+    are kept, and all numeric columns are converted with vectorized operations.
+
+    Parameters:
+    - csvdataset (str): The link to the dataset in CSV format.
+    - cachefile (str): The cache file, e.g. ibtracs.ALL.list.v04r00.npy.
+
+    Returns:
+    None
+    """
+    selected_columns = ["SEASON", "BASIN", "NAME", "LAT",
+                        "LON", "ISO_TIME", "WMO_WIND",
+                        "WMO_PRES", "USA_RMW"]
+    df = pd.read_csv(csvdataset, usecols=selected_columns, keep_default_na=False, dtype=str)
+    df = df[df['WMO_WIND'].str.isnumeric() & df['WMO_PRES'].str.isnumeric() & df['USA_RMW'].str.isnumeric()]
+    for column in ['SEASON', 'LAT', 'LON']:
+        df[column] = pd.to_numeric(df[column], errors='coerce')
+    df = df[df[['SEASON', 'LAT', 'LON']].notna().all(axis=1)]
+    records = np.empty(len(df), dtype=[('INDEX', 'i8'), ('SEASON', 'i4'), ('BASIN', 'U2'),
+                                       ('NAME', 'U' + str(max(df['NAME'].str.len().max(), 1) if len(df) > 0 else 1)),
+                                       ('LAT', 'f8'), ('LON', 'f8'), ('ISO_TIME', 'U19'),
+                                       ('WMO_WIND', 'f8'), ('WMO_PRES', 'f8'), ('USA_RMW', 'f8')])
+    records['INDEX'] = df.index
+    for column in selected_columns:
+        records[column] = df[column].to_numpy()
+    tmpname = cachefile + '.' + str(os.getpid()) + '.tmp'  # the shards of a job array may all build it at once
+    with open(tmpname, 'wb') as f:
+        np.save(f, records)
+    os.replace(tmpname, cachefile)
+    stat = os.stat(csvdataset)
+    write_manifest(cachefile + '.json', {'csv': os.path.abspath(csvdataset), 'size': stat.st_size,
+                                         'mtime_ns': stat.st_mtime_ns})
+
+#########################################
+
+
+def load_besttrack(csvdataset, cachefile):
+    """
+    Memory-map the IBTrACS cache, rebuilding it first if it is missing or if the CSV has changed.
+
+    Parameters:
+    - csvdataset (str): The link to the dataset in CSV format.
+    - cachefile (str): The cache file, e.g. ibtracs.ALL.list.v04r00.npy.
+
+    Returns:
+    - ndarray: The memory-mapped record array of the best track entries.
+    """
+    stat = os.stat(csvdataset)
+    signature = {'csv': os.path.abspath(csvdataset), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    if read_manifest(cachefile + '.json') != signature or not os.path.isfile(cachefile):
+        print('Building best track cache ' + cachefile, flush=True)
+        build_besttrack_cache(csvdataset, cachefile)
+    return np.load(cachefile, mmap_mode='r')
+
+#########################################
+
+
+def query_besttrack(records, tc_name='', years='', minlat=-90.0, maxlat=90.0, minlon=-180.0, maxlon=180.0,
+                    regions='', maxwind=10000, minwind=0, maxpres=10000, minpres=0, maxrmw=10000, minrmw=0):
+    """
+    Select best track entries from the cache with a single composed mask, following the same rules as
+    process_years, process_name, process_regions, trim_area, trim_wind_range, trim_pressure_range and
+    trim_rmw_range.
+
+    Parameters:
+    - records (ndarray): The record array from load_besttrack.
+    - tc_name, years, minlat, maxlat, minlon, maxlon, regions, maxwind, minwind, maxpres, minpres,
+      maxrmw, minrmw: The search values, see merge_data.
+
+    Returns:
+    - DataFrame: The selected entries, sorted by ISO_TIME and indexed by their row in the CSV.
+    """
+    mask = np.ones(len(records), dtype=bool)
+    if isinstance(years, list):
+        mask &= np.isin(records['SEASON'], [int(year) for year in years])
+    elif years != '' and years is not None:
+        mask &= records['SEASON'] == int(years)
+    for column, values in [('NAME', tc_name), ('BASIN', regions)]:
+        if isinstance(values, list) and all(isinstance(elem, str) for elem in values):
+            mask &= np.isin(records[column], values)
+        elif isinstance(values, str) and values != '':
+            mask &= records[column] == values
+    if not (minlat == -90.0 and maxlat == 90.0 and minlon == -180.0 and maxlon == 180.0):
+        mask &= (records['LAT'] <= maxlat) & (records['LAT'] >= minlat) & (records['LON'] >= minlon) & (records['LON'] <= maxlon)
+    for column, maxval, minval in [('WMO_WIND', maxwind, minwind), ('WMO_PRES', maxpres, minpres),
+                                   ('USA_RMW', maxrmw, minrmw)]:
+        if not (maxval == 10000 and minval == 0):
+            mask &= (records[column] <= maxval) & (records[column] >= minval)
+    selected = records[mask]
+    filtered_df = pd.DataFrame({column: selected[column] for column in selected.dtype.names if column != 'INDEX'},
+                               index=selected['INDEX'])
+    return filtered_df.sort_values('ISO_TIME')
+
+#########################################
+
+
+def build_catalog(datapath, catalogfile):
+    """
+    Scan the MERRA-2 data path once and persist a catalog of the inst3_3d_asm_Np file of each day.
+    When a day has both streams 400 and 401, the file of stream 401 is used, as in get_runid.
+
+    Parameters:
+    - datapath (str): Path to the MERRA-2 data.
+    - catalogfile (str): The catalog file, e.g. MERRA2_catalog.json.
+
+    Returns:
+    - dict: The catalog, with the datapath, its mtime and the file name of each day (YYYYMMDD).
+    """
+    files = {}
+    pattern = re.compile(r'MERRA2_(\d{3})\.inst3_3d_asm_Np\.(\d{8})\.nc4')
+    with os.scandir(datapath) as entries:
+        for entry in entries:
+            match = pattern.fullmatch(entry.name)
+            if match is None:
+                continue
+            day = match.group(2)
+            if day not in files or match.group(1) == '401':
+                files[day] = entry.name
+    catalog = {'datapath': os.path.abspath(datapath), 'mtime_ns': os.stat(datapath).st_mtime_ns,
+               'files': dict(sorted(files.items()))}
+    write_manifest(catalogfile, catalog)
+    return catalog
+
+#########################################
+
+
+def load_catalog(datapath, catalogfile):
+    """
+    Load the catalog of MERRA-2 files, rebuilding it if it is missing, built for another data path, or
+    if files were added to or removed from the data path since (which changes its mtime).
+
+    Parameters:
+    - datapath (str): Path to the MERRA-2 data.
+    - catalogfile (str): The catalog file, e.g. MERRA2_catalog.json.
+
+    Returns:
+    - dict: The file name of each day (YYYYMMDD).
+    """
+    catalog = read_manifest(catalogfile)
+    if (catalog is None or catalog['datapath'] != os.path.abspath(datapath)
+            or catalog['mtime_ns'] != os.stat(datapath).st_mtime_ns):
+        print('Building MERRA-2 catalog ' + catalogfile, flush=True)
+        catalog = build_catalog(datapath, catalogfile)
+    return catalog['files']
+
+#########################################
+
+
+def window_halfsizes(windowsize):
+    """
+    Convert a window size in degree to half of its number of grid points in latitude and longitude.
+
+    Parameters:
+    - windowsize (list): The window size [lat, lon] in degree.
+
+    Returns:
+    - tuple: (latsize, lonsize), the window has 2*latsize x 2*lonsize grid points.
+    """
+    latsize = int(np.ceil((np.ceil(windowsize[0]/0.5)+1)/2))  #change 0.625 and 0.5 for other dataset
+    lonsize = int(np.ceil((np.ceil(windowsize[1]/0.625)+1)/2))
+    return latsize, lonsize
+
+#########################################
+
+
+def crop_index(windowsize, cropsize):
+    """
+    Locate a smaller window inside a larger one around the same TC center. The windows of all sizes
+    start gblat-latsize+1 and gblon-lonsize+1, so the smaller window is the same centered slice of
+    every larger window, e.g. the 18x18 window is [12:50, 10:40] of the 30x30 window.
+
+    Parameters:
+    - windowsize (list): The size [lat, lon] in degree of the larger window.
+    - cropsize (list): The size [lat, lon] in degree of the smaller window.
+
+    Returns:
+    - tuple: The lat and lon slices of the smaller window in the larger one.
+    """
+    latsize, lonsize = window_halfsizes(windowsize)
+    croplat, croplon = window_halfsizes(cropsize)
+    if croplat > latsize or croplon > lonsize:
+        raise ValueError('Window ' + str(cropsize) + ' is larger than window ' + str(windowsize))
+    return slice(latsize - croplat, latsize + croplat), slice(lonsize - croplon, lonsize + croplon)
+
+#########################################
+
+
+def crop_window(window, windowsize, cropsize):
+    """
+    Serve a smaller TC window as a view of a larger one, see crop_index. Works on a single window as
+    well as on the samples of a store. Note that TCs too close to the poles for the larger window have
+    no larger window to crop from, even if the smaller one fits.
+
+    Parameters:
+    - window (Dataset): The window(s) of size windowsize, with lat and lon dimensions.
+    - windowsize (list): The size [lat, lon] in degree of the window.
+    - cropsize (list): The size [lat, lon] in degree of the cropped window.
+
+    Returns:
+    - Dataset: The cropped window(s).
+    """
+    latslice, lonslice = crop_index(windowsize, cropsize)
+    return window.isel(lat=latslice, lon=lonslice)
+
+#########################################
+
+
+def check_time(time):
+    """
+    Check that a best track time falls on one of the 3-hourly MERRA-2 analysis times.
+
+    Parameters:
+    - time (str): ISO_TIME of the best track entry, in '%Y-%m-%d %H:%M:%S' format.
+
+    Returns:
+    - str or None: The reason why the entry is faulty, or None if the time is valid.
+    """
+    parsed = datetime.strptime(time, '%Y-%m-%d %H:%M:%S')
+    if parsed.minute != 0:
+        return 'unexpected minute'
+    if parsed.second != 0:
+        return 'unexpected second'
+    if parsed.strftime('%H') not in ['00', '03', '06', '09', '12', '15', '18', '21']:
+        return 'unexpected hour'
+    return None
+
+#########################################
+
+
+def pad_snapshot(snapshot, lonsize):
+    """
+    Pad a global MERRA-2 time slice with lonsize wrap-around columns on each side in longitude, so that
+    every TC window, across the antimeridian or not, is a plain slice of the padded slab. The padding
+    copies the slab once per time slice instead of twice per window.
+
+    Parameters:
+    - snapshot (Dataset): The global MERRA-2 dataset at a single time.
+    - lonsize (int): Half of the number of grid points of the window in longitude.
+
+    Returns:
+    - Dataset: The padded time slice, with len(lon) + 2*lonsize longitudes.
+    """
+    return xr.concat([snapshot.isel(lon=slice(-lonsize, None)), snapshot, snapshot.isel(lon=slice(0, lonsize))],
+                     dim='lon', data_vars='minimal', coords='minimal', compat='override', join='override')
+
+#########################################
+
+
+def window_bounds(clat, clon, latsize, lonsize, nlat, nlon, pad=None):
+    """
+    Compute the index bounds of the windows around all TC centers of a time step in one vectorized pass.
+    Longitude bounds index the slab padded by pad_snapshot.
+
+    Parameters:
+    - clat (ndarray): Latitudes of the TC centers.
+    - clon (ndarray): Longitudes of the TC centers, in [-180, 180) or shifted by -360 for EP/SP.
+    - latsize (int): Half of the number of grid points of the window in latitude.
+    - lonsize (int): Half of the number of grid points of the window in longitude.
+    - nlat (int): Number of latitudes of the global grid.
+    - nlon (int): Number of longitudes of the global grid.
+    - pad (int): Number of columns padded on each side of the slab, at least lonsize. Default is lonsize.
+
+    Returns:
+    - tuple: (bounds, inside), where bounds is an (n, 4) int array of the lower/upper lat and lower/upper
+             lon indices of each window, and inside is False for windows outside of map.
+    """
+    gblat = (np.asarray(clat, dtype=float) + 90) // 0.5
+    gblon = ((np.asarray(clon, dtype=float) + 180) // 0.625) % nlon
+    if pad is None:
+        pad = lonsize
+    bounds = np.stack([gblat - latsize + 1, gblat + latsize + 1,
+                       gblon + pad - lonsize + 1, gblon + pad + lonsize + 1], axis=-1).astype(int)
+    inside = (bounds[:, 0] >= 0) & (bounds[:, 1] <= nlat - 1)
+    return bounds, inside
+
+#########################################
+
+
+def window_relname(basin, formatted_datetime, windowsize, suffix):
+    """
+    Build the name of a TC window relative to the TC_domain folder.
+
+    Parameters:
+    - basin (str): Basin of the TC.
+    - formatted_datetime (str): Time of the window in YYYYMMDDHH format.
+    - windowsize (list): The window size [lat, lon] in degree.
+    - suffix (int): Index of the TC among all TCs recorded at the same time.
+
+    Returns:
+    - str: The relative name, e.g. NA/2001/MERRA_TC18x182001010112_4.nc
+    """
+    return (basin + '/' + formatted_datetime[:4] + '/' + 'MERRA_TC' + str(windowsize[0]) + 'x' + str(windowsize[1])
+            + formatted_datetime + '_' + str(suffix) + '.nc')
+
+#########################################
+
+
+def window_filename(outputpath, basin, formatted_datetime, windowsize, suffix):
+    """
+    Build the output name of a TC window and create its basin/year folder if needed.
+
+    Parameters:
+    - outputpath (str): Root of the output, under which TC_domain/ is created.
+    - basin (str): Basin of the TC.
+    - formatted_datetime (str): Time of the window in YYYYMMDDHH format.
+    - windowsize (list): The window size [lat, lon] in degree.
+    - suffix (int): Index of the TC among all TCs recorded at the same time.
+
+    Returns:
+    - str: The file name, e.g. TC_domain/NA/2001/MERRA_TC18x182001010112_4.nc
+    """
+    outname = outputpath + 'TC_domain/' + basin + '/' + formatted_datetime[:4]
+    if not os.path.exists(outname):
+        os.makedirs(outname, exist_ok=True)
+    return outputpath + 'TC_domain/' + window_relname(basin, formatted_datetime, windowsize, suffix)
+
+#########################################
+
+
+def window_encoding(window, encoding=''):
+    """
+    Build the NetCDF encoding of the fields of a TC window. xarray decodes the packed fields back to
+    float32 with NaN when the window is opened, so the readers of the windows are unchanged.
+
+    Parameters:
+    - window (Dataset): The TC window.
+    - encoding (dict): Options of each field keyed by variable name, with the options of the fields not
+                       listed under 'default', e.g. {'default': {'compression': 'zlib', 'complevel': 4},
+                       'SLP': {'packing': 'int16'}}. The options are:
+                       - compression (str): 'zlib', or a filter of netCDF4 >= 1.6 such as 'zstd' or
+                         'blosc_lz4'. Default is '' (no compression).
+                       - complevel (int): Compression level. Default is 4.
+                       - shuffle (bool): Byte shuffle before compression. Default is True.
+                       - chunksizes (tuple): Chunk sizes of the field, one per dimension. Under 'default',
+                         a tuple for the 3-D fields (lev, lat, lon) is trimmed to its last sizes for the
+                         2-D fields (lat, lon) such as SLP. Default is chosen by netCDF.
+                       - packing (str): 'int16' to pack the field into 16-bit integers with a scale
+                         factor and offset fitted to the range of the window (NaN kept as fill value),
+                         or 'float16' to keep float16 precision (10 mantissa bits rounded with BitRound),
+                         since NetCDF has no 16-bit float type. Default is '' (plain float32).
+                       - significant_digits (int): Decimal digits kept by netCDF quantization, if no packing.
+
+    Returns:
+    - dict: The encoding to pass to to_netcdf, empty if encoding is ''.
+    """
+    if encoding == '':
+        return {}
+    result = {}
+    for name, field in window.data_vars.items():
+        options = dict(encoding.get('default', {}))
+        options.update(encoding.get(name, {}))
+        field_encoding = {}
+        compression = options.get('compression', '')
+        if compression == 'zlib':
+            field_encoding.update(zlib=True, complevel=options.get('complevel', 4), shuffle=options.get('shuffle', True))
+        elif compression.startswith('blosc'):
+            field_encoding.update(compression=compression, complevel=options.get('complevel', 4),
+                                  blosc_shuffle=1 if options.get('shuffle', True) else 0)
+        elif compression != '':
+            field_encoding.update(compression=compression, complevel=options.get('complevel', 4),
+                                  shuffle=options.get('shuffle', True))
+        if 'chunksizes' in options:
+            chunksizes = tuple(options['chunksizes'])
+            if 'chunksizes' not in encoding.get(name, {}) and len(chunksizes) > field.ndim:
+                chunksizes = chunksizes[len(chunksizes) - field.ndim:]
+            if len(chunksizes) != field.ndim:
+                raise ValueError('chunksizes ' + str(chunksizes) + ' of ' + name + ' do not match its dimensions '
+                                 + str(field.dims) + '.')
+            field_encoding['chunksizes'] = tuple(min(size, length) for size, length in zip(chunksizes, field.shape))
+        packing = options.get('packing', '')
+        if packing == 'int16':
+            values = field.values
+            vmin = np.nanmin(values) if np.any(np.isfinite(values)) else 0.0
+            vmax = np.nanmax(values) if np.any(np.isfinite(values)) else 0.0
+            scale = (vmax - vmin) / (2**16 - 2) if vmax > vmin else 1.0
+            field_encoding.update(dtype='int16', scale_factor=np.float32(scale), add_offset=np.float32((vmax + vmin) / 2),
+                                  _FillValue=np.int16(-2**15))
+        elif packing == 'float16':
+            field_encoding.update(quantize_mode='BitRound', significant_digits=10)
+        elif packing != '':
+            raise ValueError('Unknown packing ' + str(packing) + ', use int16 or float16.')
+        elif 'significant_digits' in options:
+            field_encoding['significant_digits'] = options['significant_digits']
+        result[name] = field_encoding
+    return result
+
+#########################################
+
+
+def shard_of(key, shard_count):
+    """
+    Assign a key to a shard with a hash that does not change between runs or machines, unlike hash().
+
+    Parameters:
+    - key (str): The key, e.g. the day YYYY-MM-DD of a MERRA-2 file.
+    - shard_count (int): The number of shards.
+
+    Returns:
+    - int: The shard of the key, in [0, shard_count).
+    """
+    return zlib.crc32(key.encode()) % shard_count
+
+#########################################
+
+
+def shard_suffix(shard_index, shard_count):
+    """
+    Build the suffix of the outputs of a shard, so that the shards of a job array never share a file.
+
+    Parameters:
+    - shard_index (int): The shard, in [0, shard_count).
+    - shard_count (int): The number of shards.
+
+    Returns:
+    - str: '' without sharding, else e.g. _shard3of8.
+    """
+    if shard_count <= 1:
+        return ''
+    return '_shard' + str(shard_index) + 'of' + str(shard_count)
+
+#########################################
+
+
+def store_filename(outputpath, windowsize, suffix=''):
+    """
+    Build the name of the consolidated store of all TC windows of a given size.
+
+    Parameters:
+    - outputpath (str): Root of the output, under which TC_domain/ is created.
+    - windowsize (list): The window size [lat, lon] in degree.
+    - suffix (str): The shard suffix, see shard_suffix.
+
+    Returns:
+    - str: The store name, e.g. TC_domain/MERRA_TC18x18.nc or TC_domain/MERRA_TC18x18_shard3of8.nc
+    """
+    outname = outputpath + 'TC_domain'
+    if not os.path.exists(outname):
+        os.makedirs(outname, exist_ok=True)
+    return outname + '/MERRA_TC' + str(windowsize[0]) + 'x' + str(windowsize[1]) + suffix + '.nc'
+
+#########################################
+
+
+def create_store(storename, window):
+    """
+    Create a consolidated store for TC windows, as a chunked NetCDF4/HDF5 file with an unlimited sample
+    axis. Each field is chunked by sample, the lat/lon of each window and the VMAX, PMIN, RMW, CLAT, CLON,
+    TCNAME, BASIN, ISO_TIME and WINDOW (the name the window has in the TC_domain tree) attributes are
+    stored as coordinate arrays along the sample axis. VALID is 0 for the samples of a day extracted
+    again, see invalidate_store.
+
+    Parameters:
+    - storename (str): The store name.
+    - window (Dataset): A TC window giving the fields and dimensions of the store.
+
+    Returns:
+    None
+    """
+    with nc.Dataset(storename, 'w') as store:
+        store.createDimension('sample', None)
+        store.createDimension('lat', len(window.lat))
+        store.createDimension('lon', len(window.lon))
+        if 'lev' in window.dims:
+            store.createDimension('lev', len(window.lev))
+            store.createVariable('lev', 'f8', ('lev',))[:] = window.lev.values
+            store['lev'].setncatts({k: v for k, v in window.lev.attrs.items() if not k.startswith('_')})
+        store.createVariable('window_lat', 'f8', ('sample', 'lat'), chunksizes=(1, len(window.lat)))
+        store.createVariable('window_lon', 'f8', ('sample', 'lon'), chunksizes=(1, len(window.lon)))
+        for name in ['VMAX', 'PMIN', 'RMW', 'CLAT', 'CLON']:
+            store.createVariable(name, 'f8', ('sample',))
+        for name in ['TCNAME', 'BASIN', 'ISO_TIME', 'WINDOW']:
+            store.createVariable(name, str, ('sample',))
+        store.createVariable('VALID', 'i1', ('sample',))
+        for name, field in window.data_vars.items():
+            dims = ('sample',) + field.dims
+            chunks = (1,) + field.shape
+            store.createVariable(name, 'f4', dims, chunksizes=chunks)
+            store[name].setncatts({k: v for k, v in field.attrs.items() if not k.startswith('_')})
+        store.setncattr('nsample', 0)
+
+#########################################
+
+
+def append_store(storename, windows, start):
+    """
+    Write TC windows into the consolidated store, from a given sample index on. Samples beyond that
+    index left over by an interrupted run are overwritten.
+
+    Parameters:
+    - storename (str): The store name.
+    - windows (list): (relname, basin, iso_time, window) of each TC window.
+    - start (int): Index of the first sample to write.
+
+    Returns:
+    - int: Index after the last written sample.
+    """
+    if not os.path.isfile(storename):
+        create_store(storename, windows[0][3])
+    with nc.Dataset(storename, 'a') as store:
+        n = start
+        for relname, basin, iso_time, window in windows:
+            store['window_lat'][n] = window.lat.values
+            store['window_lon'][n] = window.lon.values
+            for name in ['VMAX', 'PMIN', 'RMW', 'CLAT', 'CLON']:
+                store[name][n] = window.attrs[name]
+            store['TCNAME'][n] = window.attrs['TCNAME']
+            store['BASIN'][n] = basin
+            store['ISO_TIME'][n] = iso_time
+            store['WINDOW'][n] = relname
+            store['VALID'][n] = 1
+            for name, field in window.data_vars.items():
+                store[name][n] = field.values
+            n += 1
+        store.setncattr('nsample', n)
+    return n
+
+#########################################
+
+
+def invalidate_store(storename, committed, stale):
+    """
+    Prepare the consolidated store for a resumed run. Samples beyond the last one committed by a finished
+    day are dropped, and the samples of the days extracted again are marked as not VALID, since the new
+    samples of these days are appended after the committed ones rather than written over the old ones.
+
+    Parameters:
+    - storename (str): The store name.
+    - committed (int): Index after the last sample committed by a finished day, see the manifests.
+    - stale (list): [start, end] sample ranges of the days extracted again.
+
+    Returns:
+    None
+    """
+    with nc.Dataset(storename, 'a') as store:
+        if 'VALID' not in store.variables:
+            store.createVariable('VALID', 'i1', ('sample',))
+            if store.dimensions['sample'].size > 0:
+                store['VALID'][:store.dimensions['sample'].size] = 1
+        for start, end in stale:
+            if end > start:
+                store['VALID'][start:end] = 0
+        store.setncattr('nsample', committed)
+
+#########################################
+
+
+def open_store(storename):
+    """
+    Open the consolidated store of TC windows lazily. Any subset of samples can then be read with
+    isel(sample=...) or by masking on the coordinate arrays, without opening per-sample files.
+
+    Parameters:
+    - storename (str): The store name.
+
+    Returns:
+    - Dataset: The store, limited to the valid samples committed by finished days.
+    """
+    store = xr.open_dataset(storename)
+    store = store.set_coords([name for name in ['window_lat', 'window_lon', 'VMAX', 'PMIN', 'RMW', 'CLAT', 'CLON',
+                              'TCNAME', 'BASIN', 'ISO_TIME', 'WINDOW', 'VALID'] if name in store.variables])
+    store = store.isel(sample=slice(0, int(store.attrs['nsample'])))
+    if 'VALID' in store.coords:
+        store = store.isel(sample=np.flatnonzero(store['VALID'].values == 1))
+    return store
+
+#########################################
+
+
+def convert_date_to_cyclic(date_str):
+    """
+    Convert a date in 'YYYYMMDD' format to a cyclic representation using sine and cosine,
+    as in TC-extract_data_TSU.py.
+
+    Parameters:
+    - date_str (str): Date string in 'YYYYMMDD' format.
+
+    Returns:
+    - tuple: The sine and cosine representations of the day of the year.
+    """
+    date = datetime.strptime(date_str, "%Y%m%d")
+    day_of_year = date.timetuple().tm_yday
+    days_in_year = 366 if date.year % 4 == 0 and (date.year % 100 != 0 or date.year % 400 == 0) else 365
+    return np.sin(2 * np.pi * day_of_year / days_in_year), np.cos(2 * np.pi * day_of_year / days_in_year)
+
+#########################################
+
+
+def channel_list(channels=None):
+    """
+    Resolve a channel specification, as channel_list in TC-extract_data.py.
+
+    Parameters:
+    - channels (list): (variable, level) of each channel, with level in mb, or None for the surface
+                       fields such as SLP. None stands for the 13 channels U, V, T, RH at 850, 950 and
+                       750mb, then SLP.
+
+    Returns:
+    - list: The (variable, level) of each channel.
+    """
+    if channels is None:
+        return [(name, level) for level in (850, 950, 750) for name in ('U', 'V', 'T', 'RH')] + [('SLP', None)]
+    return [(name, level) for name, level in channels]
+
+#########################################
+
+
+def channel_array(data, channels=None):
+    """
+    Select the channels of a window into one block, in the order of the specification, as channel_array
+    in TC-extract_data.py, so that the streamed features match the dumped ones.
+
+    Parameters:
+    - data (Dataset): The TC window.
+    - channels (list): The channel specification, see channel_list.
+
+    Returns:
+    - ndarray: The channels, of shape (1, number of channels, lat, lon).
+    """
+    channels = channel_list(channels)
+    upper = [n for n, (name, level) in enumerate(channels) if level is not None]
+    names = list(dict.fromkeys(channels[n][0] for n in upper))
+    levels = list(dict.fromkeys(channels[n][1] for n in upper))
+    dtype = np.result_type(*[data[name].dtype for name in dict.fromkeys(name for name, level in channels)])
+    block = np.empty((1, len(channels), data.sizes['lat'], data.sizes['lon']), dtype=dtype)
+    if len(upper) > 0:
+        fields = data[names].sel(lev=levels).to_array().transpose('variable', 'lev', 'lat', 'lon').values
+        block[0, upper] = fields[[names.index(channels[n][0]) for n in upper], [levels.index(channels[n][1]) for n in upper]]
+    for n, (name, level) in enumerate(channels):
+        if level is None:
+            block[0, n] = data[name].transpose('lat', 'lon').values
+    return block
+
+#########################################
+
+
+def stream_record(relname, formatted_datetime, window, features):
+    """
+    Build the sample index record of a streamed window, the same as window_record in TC-extract_data.py
+    for the window in the TC_domain tree.
+
+    Parameters:
+    - relname (str): The name of the window relative to TC_domain/, see window_relname.
+    - formatted_datetime (str): Time of the window in YYYYMMDDHH format.
+    - window (Dataset): The TC window with its VMAX, PMIN, RMW, CLAT, CLON and TCNAME attributes.
+    - features (ndarray): The features of the window, for the NaN percentage.
+
+    Returns:
+    - ndarray: One record of dtype index_dtype.
+    """
+    record = np.zeros(1, dtype=index_dtype)
+    record['window'] = relname
+    record['tcname'] = str(window.attrs.get('TCNAME', ''))
+    record['basin'] = relname[0:2]
+    record['iso_time'] = (formatted_datetime[0:4] + '-' + formatted_datetime[4:6] + '-' + formatted_datetime[6:8] + ' '
+                          + formatted_datetime[8:10] + ':00:00')
+    record['clat'] = window.attrs['CLAT']
+    record['clon'] = window.attrs['CLON']
+    record['nan_percent'] = 100 * np.mean(np.isnan(features))
+    record['vmax'] = window.attrs['VMAX']
+    record['pmin'] = window.attrs['PMIN']
+    record['rmw'] = window.attrs['RMW']
+    return record
+
+#########################################
+
+
+def stream_sample(window, relname, formatted_datetime, omit_percent=5, channels=None):
+    """
+    Select the channels of a TC window and screen its NaN, the same way as dumping_data in
+    TC-extract_data.py and TC-extract_data_TSU.py, without writing the window to NetCDF first.
+
+    Parameters:
+    - window (Dataset): The TC window with its VMAX, PMIN, RMW, CLAT and CLON attributes.
+    - relname (str): The name of the window relative to TC_domain/, for the sample index.
+    - formatted_datetime (str): Time of the window in YYYYMMDDHH format.
+    - omit_percent (float): Upper limit of acceptable NaN percentage in the first four channels (the 850mb band).
+    - channels (list): The channel specification of the features, see channel_list.
+
+    Returns:
+    - tuple or None: The features (1, channels, lat, lon), labels (1, 3), space-time info (1, 4) and index
+                     record (1,) of the sample, or None if the sample is omitted due to NaNs.
+    """
+    data_array_x = channel_array(window, channels)[0]
+    if np.sum(np.isnan(data_array_x[0:4])) / 4 > omit_percent / 100 * np.prod(data_array_x[0].shape):
+        return None
+    sin_day, cos_day = convert_date_to_cyclic(formatted_datetime[:8])
+    data_array_y = np.array([window.attrs['VMAX'], window.attrs['PMIN'], window.attrs['RMW']])  # knots, mb, nmile
+    data_array_z = np.array([sin_day, cos_day, window.attrs['CLAT'], window.attrs['CLON']])
+    record = stream_record(relname, formatted_datetime, window, data_array_x)
+    return data_array_x[np.newaxis], data_array_y[np.newaxis], data_array_z[np.newaxis], record
+
+#########################################
+
+
+def stream_outnames(windowsize, suffix='', channels=None):
+    """
+    Build the names of the feature, label, space-time and sample index arrays written by the stream backend,
+    the same as the outputs of TC-extract_data.py and TC-extract_data_TSU.py for the same channels.
+
+    Parameters:
+    - windowsize (list): The window size [lat, lon] in degree.
+    - suffix (str): The shard suffix, see shard_suffix.
+    - channels (list): The channel specification of the features, see channel_list.
+
+    Returns:
+    - list: The names without month and extension, e.g. CNNfeatures13_18x18 or CNNfeatures13_18x18_shard3of8.
+    """
+    windows = str(windowsize[0]) + 'x' + str(windowsize[1])
+    var_num = str(len(channel_list(channels)))
+    return ['CNNfeatures' + var_num + '_' + windows + suffix, 'CNNlabels' + var_num + '_' + windows + suffix,
+            'CNNspace_time_info' + var_num + '_' + windows + suffix, 'CNNindex' + var_num + '_' + windows + suffix]
+
+#########################################
+
+
+def write_channel_spec(streampath, windowsize, suffix='', channels=None):
+    """
+    Write the channel layout of the stream arrays next to them, as write_channel_spec in TC-extract_data.py
+    does for the dumped arrays, so that TC-CA_NaN_filling.py can check it (see check_channels).
+
+    Parameters:
+    - streampath (str): The output directory of the arrays.
+    - windowsize (list): The window size [lat, lon] in degree.
+    - suffix (str): The shard suffix, see shard_suffix.
+    - channels (list): The channel specification of the features, see channel_list.
+
+    Returns:
+    None
+    """
+    channels = channel_list(channels)
+    outnames = stream_outnames(windowsize, suffix, channels)
+    write_manifest(streampath + outnames[0] + '_channels.json',
+                   {'channels': [[name, level] for name, level in channels], 'var_num': len(channels),
+                    'windowsize': list(windowsize), 'outputs': outnames, 'labels': ['VMAX', 'PMIN', 'RMW']})
+
+#########################################
+
+
+def stream_cold_start(streampath, windowsize, suffix='', channels=None):
+    """
+    Remove the arrays of a previous stream run, but not the NaN filled ones (...fixed.npy).
+
+    Parameters:
+    - streampath (str): The output directory of the arrays.
+    - windowsize (list): The window size [lat, lon] in degree.
+    - suffix (str): The shard suffix, see shard_suffix.
+    - channels (list): The channel specification of the features, see channel_list.
+
+    Returns:
+    None
+    """
+    if not os.path.exists(streampath):
+        os.makedirs(streampath, exist_ok=True)
+    for outname in stream_outnames(windowsize, suffix, channels):
+        for filename in glob.glob(streampath + outname + '*.npy'):
+            if re.fullmatch(re.escape(outname) + r'(\d\d)?\.npy', os.path.basename(filename)):
+                os.remove(filename)
+
+#########################################
+
+
+def merge_stream_shards(streampath, windowsize, shard_count, channels=None):
+    """
+    Merge the training arrays written by the shards of a stream job array into the canonical arrays,
+    with the samples in the order of the days, the same as a single stream run. Each shard writes the
+    layout of its arrays (month and number of samples of each day) next to them, see extract_by_day,
+    and the channel layout, which must be the same for all the shards.
+
+    Parameters:
+    - streampath (str): The output directory of the arrays.
+    - windowsize (list): The window size [lat, lon] in degree.
+    - shard_count (int): The number of shards of the job array.
+    - channels (list): The channel specification of the features, see channel_list.
+
+    Returns:
+    - int: The number of samples merged.
+    """
+    blocks = []
+    for shard_index in range(shard_count):
+        suffix = shard_suffix(shard_index, shard_count)
+        layout = read_manifest(streampath + stream_outnames(windowsize, suffix, channels)[0] + '.json')
+        if layout is None:
+            raise FileNotFoundError('Shard ' + str(shard_index) + ' of ' + str(shard_count) + ' has not finished, no layout in '
+                                    + streampath + stream_outnames(windowsize, suffix, channels)[0] + '.json')
+        spec = read_manifest(streampath + stream_outnames(windowsize, suffix, channels)[0] + '_channels.json')
+        if spec is None or spec['channels'] != [[name, level] for name, level in channel_list(channels)]:
+            raise ValueError('Shard ' + str(shard_index) + ' of ' + str(shard_count) + ' was not streamed with the channels '
+                             + str(channel_list(channels)))
+        start = {}
+        for day, month, n in layout:
+            blocks.append((day, month, suffix, start.get(month, 0), n))
+            start[month] = start.get(month, 0) + n
+    stream_cold_start(streampath, windowsize, channels=channels)
+    outnames = stream_outnames(windowsize, channels=channels)
+    for month in sorted(set(block[1] for block in blocks)):
+        month_blocks = sorted(block for block in blocks if block[1] == month)
+        total = sum(block[4] for block in month_blocks)
+        for k in range(len(outnames)):
+            shards = {}
+            merged = None
+            n = 0
+            for day, month, suffix, start, count in month_blocks:
+                if suffix not in shards:
+                    shards[suffix] = np.load(streampath + stream_outnames(windowsize, suffix, channels)[k] + month + '.npy', mmap_mode='r')
+                if merged is None:
+                    merged = np.lib.format.open_memmap(streampath + outnames[k] + month + '.npy', mode='w+',
+                                                       dtype=shards[suffix].dtype, shape=(total,) + shards[suffix].shape[1:])
+                merged[n:n + count] = shards[suffix][start:start + count]
+                n += count
+            merged.flush()
+            del merged
+    write_channel_spec(streampath, windowsize, channels=channels)
+    print('Merged ' + str(len(blocks)) + ' days from ' + str(shard_count) + ' shards into ' + streampath + outnames[0] + '*.npy', flush=True)
+    return sum(block[4] for block in blocks)
+
+#########################################
+
+
+def select_fields(dataset, variables='', levels=''):
+    """
+    Keep only the given variables and pressure levels of a MERRA-2 dataset. The selection is lazy,
+    so that only the selected fields are read from disk and written to the TC windows.
+
+    Parameters:
+    - dataset (Dataset): The MERRA-2 dataset.
+    - variables (str or list): The variable(s) to keep, e.g. ['U', 'V', 'T', 'RH', 'SLP']. All if ''.
+    - levels (float or list): The pressure level(s) in hPa to keep, e.g. [750, 850, 950]. All if ''.
+                   Surface variables such as SLP are kept whatever the levels.
+
+    Returns:
+    - Dataset: The selected dataset.
+    """
+    if variables != '':
+        if isinstance(variables, str):
+            variables = [variables]
+        dataset = dataset[variables]
+    if levels != '':
+        if not isinstance(levels, list):
+            levels = [levels]
+        dataset = dataset.sel(lev=levels)
+    return dataset
+
+#########################################
+
+
+def manifest_filename(outputpath, windowsize, day, backend='netcdf', suffix=''):
+    """
+    Build the name of the manifest of a day task, stored next to (not inside) the TC_domain tree. The
+    manifests of the store and stream backends are kept apart from those of the NetCDF windows and per
+    shard, like their outputs, so that a run with another backend never takes their days as done.
+
+    Parameters:
+    - outputpath (str): Root of the output, under which TC_manifest/ is created.
+    - windowsize (list): The window size [lat, lon] in degree.
+    - day (str): Day of the task in YYYY-MM-DD format.
+    - backend (str): The backend of the task, see extract_by_day.
+    - suffix (str): The shard suffix of the store or training arrays, see shard_suffix.
+
+    Returns:
+    - str: The manifest name, e.g. TC_manifest/18x18/2001-01-01.json or TC_manifest/18x18/store_shard3of8/2001-01-01.json
+    """
+    outname = outputpath + 'TC_manifest/' + str(windowsize[0]) + 'x' + str(windowsize[1])
+    if backend != 'netcdf':
+        outname = outname + '/' + backend + suffix
+    if not os.path.exists(outname):
+        os.makedirs(outname, exist_ok=True)
+    return outname + '/' + day + '.json'
+
+#########################################
+
+
+def read_manifest(filename):
+    """
+    Read the manifest of a day task.
+
+    Parameters:
+    - filename (str): The manifest name.
+
+    Returns:
+    - dict or None: The manifest, or None if the task has not finished (or the file is unreadable).
+    """
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+#########################################
+
+
+def write_manifest(filename, manifest):
+    """
+    Write the manifest of a day task atomically, so that a crash never leaves a partial manifest.
+
+    Parameters:
+    - filename (str): The manifest name.
+    - manifest (dict): Entries, finished windows, faulty and out-of-map entries of the task.
+
+    Returns:
+    None
+    """
+    tmpname = filename + '.' + str(os.getpid()) + '.tmp'
+    with open(tmpname, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmpname, filename)
+
+#########################################
+
+
+def entry_keys(day_df):
+    """
+    List the keys identifying the best track entries of a day task.
+
+    Parameters:
+    - day_df (DataFrame): The best track entries of the day, with the SUFFIX column.
+
+    Returns:
+    - list: [ISO_TIME, BASIN, NAME, SUFFIX] of every entry.
+    """
+    return [[row.ISO_TIME, row.BASIN, row.NAME, int(row.SUFFIX)] for row in day_df.itertuples()]
+
+#########################################
+
+
+def index_filename(outputpath, windowsize, suffix='', kind='index'):
+    """
+    Build the name of the index of the entries extracted so far for a window size, kept with the manifests.
+    Each shard of a job array keeps the index of its own days.
+
+    Parameters:
+    - outputpath (str): Root of the output, under which TC_manifest/ is created.
+    - windowsize (list): The window size [lat, lon] in degree.
+    - suffix (str): The shard suffix, see shard_suffix.
+    - kind (str): 'index' for the entries whose window is written, 'faulty' for the faulty and out-of-map
+                  entries, which are not indexed so that the next run tries them again.
+
+    Returns:
+    - str: The index name, e.g. TC_manifest/18x18/index.json or TC_manifest/18x18/faulty_shard3of8.json
+    """
+    return manifest_filename(outputpath, windowsize, kind + suffix)
+
+#########################################
+
+
+def index_records(day_df):
+    """
+    Build the index records of best track entries. The key identifies the fix of a storm by ISO_TIME,
+    BASIN and NAME (numbered for the UNNAMED storms sharing a time), the value holds everything the window
+    depends on, so an entry is extracted again whenever its position, intensity or file suffix changes.
+
+    Parameters:
+    - day_df (DataFrame): The best track entries, with the SUFFIX column.
+
+    Returns:
+    - dict: [SUFFIX, LAT, LON, WMO_WIND, WMO_PRES, USA_RMW] keyed by 'ISO_TIME|BASIN|NAME|n'.
+    """
+    occurrence = day_df.groupby(['ISO_TIME', 'BASIN', 'NAME'], sort=False).cumcount()
+    return {row.ISO_TIME + '|' + row.BASIN + '|' + row.NAME + '|' + str(n):
+            [int(row.SUFFIX), float(row.LAT), float(row.LON), float(row.WMO_WIND), float(row.WMO_PRES), float(row.USA_RMW)]
+            for row, n in zip(day_df.itertuples(), occurrence)}
+
+#########################################
+
+
+def index_window(outputpath, key, value, windowsize):
+    """
+    Build the name of the NetCDF window of an index record.
+
+    Parameters:
+    - outputpath (str): Root of the output, under which TC_domain/ is created.
+    - key (str): The key of the record, see index_records.
+    - value (list): The value of the record, starting with the SUFFIX.
+    - windowsize (list): The window size [lat, lon] in degree.
+
+    Returns:
+    - str: The file name, as written by extract_day.
+    """
+    iso_time, basin = key.split('|')[:2]
+    formatted_datetime = datetime.strptime(iso_time, '%Y-%m-%d %H:%M:%S').strftime('%Y%m%d%H')
+    return outputpath + 'TC_domain/' + window_relname(basin, formatted_datetime, windowsize, value[0])
+
+#########################################
+
+
+def save_indexes(outputpath, sizenames, shard_index=0, shard_count=1):
+    """
+    Write the indexes of the extracted and of the faulty entries of some window sizes atomically, keeping
+    only the days of the shard.
+
+    Parameters:
+    - outputpath (str): Root of the output, under which TC_manifest/ is created.
+    - sizenames (iterable): The window sizes to write, e.g. ['18x18'].
+    - shard_index (int): The shard, see extract_by_day.
+    - shard_count (int): The number of shards.
+
+    Returns:
+    None
+    """
+    global index_saved
+    for sizename in sizenames:
+        for kind, index in [('index', indexes[sizename]), ('faulty', failures[sizename])]:
+            if shard_count > 1:
+                index = {key: value for key, value in index.items() if shard_of(key[:10], shard_count) == shard_index}
+            write_manifest(index_filename(outputpath, [int(size) for size in sizename.split('x')],
+                                          shard_suffix(shard_index, shard_count), kind), index)
+    index_saved = timer()
+
+#########################################
+
+
+def add_timing(timings, stage, start):
+    """
+    Record the time spent in a stage of the extraction since start.
+
+    Parameters:
+    - timings (dict): Lists of durations in seconds, keyed by stage.
+    - stage (str): The stage, e.g. 'open', 'select', 'cut', 'attrs' or 'write'.
+    - start (float): The timer() value at the start of the stage.
+
+    Returns:
+    - float: The timer() value at the end of the stage, to start the next one.
+    """
+    end = timer()
+    timings.setdefault(stage, []).append(end - start)
+    return end
+
+#########################################
+
+
+def timing_summary(timings, elapsed, entries):
+    """
+    Summarize the per-stage timings and the throughput of the extraction.
+
+    Parameters:
+    - timings (dict): Lists of durations in seconds, keyed by stage.
+    - elapsed (float): Wall time of the extraction so far in seconds.
+    - entries (int): Number of entries of the extraction over all window sizes.
+
+    Returns:
+    - dict: Wall time, entries, windows and faulty entries so far, entries and windows per second (not
+            counting the entries done by a previous run), the bytes of the NetCDF windows in memory and on
+            disk with the percentage saved by the encoding, and the count, total, mean, p50 and p95 in seconds
+            of each stage. Stage totals are summed over the workers, so they can exceed the wall time with
+            nworkers > 1.
+    """
+    stages = {}
+    for stage, durations in timings.items():
+        stages[stage] = {'count': len(durations),
+                         'total': float(np.sum(durations)),
+                         'mean': float(np.mean(durations)),
+                         'p50': float(np.percentile(durations, 50)),
+                         'p95': float(np.percentile(durations, 95))}
+    processed = count + faulty - done_before[0] - done_before[1]
+    windows = count - done_before[0]
+    return {'elapsed': elapsed, 'entries': entries, 'processed': count + faulty, 'windows': count,
+            'faulty': faulty, 'entries_per_second': processed / elapsed if elapsed > 0 else 0.0,
+            'windows_per_second': windows / elapsed if elapsed > 0 else 0.0, 'bytes_raw': nbytes[0],
+            'bytes_written': nbytes[1], 'saved_percent': 100 * (1 - nbytes[1] / nbytes[0]) if nbytes[0] > 0 else 0.0,
+            'stages': stages}
+
+#########################################
+
+
+def report_timing(timings, elapsed, entries, timingfile=''):
+    """
+    Print the timing summary as a single JSON line starting with TIMING, and write it to a file if given.
+
+    Parameters:
+    - timings (dict): Lists of durations in seconds, keyed by stage.
+    - elapsed (float): Wall time of the extraction so far in seconds.
+    - entries (int): Number of entries of the extraction over all window sizes.
+    - timingfile (str): JSON file of the summary, rewritten at each report. Not written if ''.
+
+    Returns:
+    None
+    """
+    summary = timing_summary(timings, elapsed, entries)
+    print('TIMING ' + json.dumps(summary), flush=True)
+    if timingfile != '':
+        write_manifest(timingfile, summary)
+
+#########################################
+
+
+def read_slices(dataname, day_df, pad, options, timings):
+    """
+    Open a MERRA-2 day file and load, one after another, the padded time slices holding TCs. The
+    netCDF calls hold netcdf_lock, so that the slices can be read in a reader thread.
+
+    Parameters:
+    - dataname (str): The MERRA-2 file of the day.
+    - day_df (DataFrame): The best track entries of the day with valid times.
+    - pad (int): Number of columns padded on each side of the slices, see pad_snapshot.
+    - options (dict): The options of the task, for the variables and levels to read.
+    - timings (dict): Lists of durations in seconds of the open and select stages, see add_timing.
+
+    Returns:
+    - generator: (time, time_df, snapshot, nlat, nlon) of each time holding TCs, where nlat and nlon
+                 are the size of the global grid.
+    """
+    start = timer()
+    with netcdf_lock:
+        source = xr.open_dataset(dataname)
+    try:
+        dataset = select_fields(source, options['variables'], options['levels'])
+        add_timing(timings, 'open', start)
+        for time, time_df in day_df.groupby('ISO_TIME'):
+            start = timer()
+            with netcdf_lock:
+                snapshot = dataset.sel(time=time).load()
+            snapshot = pad_snapshot(snapshot, pad)
+            add_timing(timings, 'select', start)
+            yield time, time_df, snapshot, len(dataset.lat), len(dataset.lon)
+    finally:
+        with netcdf_lock:
+            source.close()
+
+#########################################
+
+
+def read_ahead(items, depth, timings):
+    """
+    Produce the items of a generator in a reader thread, at most depth items ahead of the consumer, so
+    that the next time slices are read while the windows of the current one are cut and written. With
+    depth time slices waiting, up to depth+2 slices are in memory at once. When the consumer stops early
+    (an error, or close()), the reader is told to stop, the generator is closed in the reader thread
+    (which closes the MERRA-2 file of read_slices) and the waiting items are dropped.
+
+    Parameters:
+    - items (generator): The generator to read ahead, e.g. read_slices.
+    - depth (int): Maximum number of items waiting in the queue.
+    - timings (dict): Lists of durations in seconds, where the time the consumer waits for the
+                      reader is recorded as the wait stage.
+
+    Returns:
+    - generator: The same items, in the same order. Errors of the reader are raised to the consumer.
+    """
+    slots = queue.Queue(maxsize=depth)
+    done = object()
+    stop = threading.Event()
+    def put(item):
+        while not stop.is_set():
+            try:
+                slots.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+    def produce():
+        try:
+            for item in items:
+                if not put(item):
+                    break
+        except BaseException as error:
+            put(error)
+        finally:
+            if hasattr(items, 'close'):
+                items.close()
+        put(done)
+    reader = threading.Thread(target=produce, daemon=True)
+    reader.start()
+    try:
+        while True:
+            start = timer()
+            item = slots.get()
+            add_timing(timings, 'wait', start)
+            if item is done:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        reader.join()
+        while not slots.empty():
+            slots.get_nowait()
+
+#########################################
+
+
+def write_window(window, outname, timings, encoding=''):
+    """
+    Write a TC window to its NetCDF file, in the task thread or in a writer thread. The writers take
+    netcdf_lock in turn with the reader, while the windows are cut beside them.
+
+    Parameters:
+    - window (Dataset): The TC window.
+    - outname (str): The file name, see window_filename.
+    - timings (dict): Lists of durations in seconds of the write stage, see add_timing.
+    - encoding (dict): Compression and packing of the fields, see window_encoding. None if ''.
+
+    Returns:
+    - list: The bytes of the fields in memory and of the file on disk.
+    """
+    start = timer()
+    window_encodings = window_encoding(window, encoding)
+    with netcdf_lock:
+        window.to_netcdf(outname, encoding=window_encodings)
+    add_timing(timings, 'write', start)
+    return [int(sum(field.nbytes for field in window.data_vars.values())), os.path.getsize(outname)]
+
+#########################################
+
+
+def extract_day(task):
+    """
+    Cut all TC windows of a single MERRA-2 day file, opening the file once and loading each time
+    slice once for all the TCs active at that time and all the window sizes. With the netcdf backend,
+    each window is written to its own file and the manifests of the task are written at the end, so a
+    day interrupted halfway has no manifest and is redone on the next run. With the store backend, the
+    windows are returned to the main process, which appends them to the store and then writes the
+    manifest. With the stream backend, the channels of each window are selected and screened for NaN
+    right away, and the samples are returned to the main process, which appends them to the training arrays.
+
+    With options['prefetch'] > 0, the time slices are read ahead by a reader thread (see read_ahead), and
+    with options['nwriters'] > 0, the NetCDF windows are written behind by a pool of writer threads, with
+    at most options['write_queue'] windows waiting to be written. The manifests are written only once
+    all the windows of the day are on disk.
+
+    Parameters:
+    - task (tuple): (day, dataname, day_df, sizes, options), where dataname is the MERRA-2 file of the day
+                    (None if it is missing), day_df holds the best track entries of the day with
+                    their SUFFIX column, sizes lists the (windowsize, latsize, lonsize) to cut for this
+                    day, and options is a dict with the datapath, outputpath, variables, levels, backend,
+                    streampath, monthly, omit_percent, channels, prefetch, nwriters, write_queue and
+                    encoding arguments of extract_by_day.
+
+    Returns:
+    - tuple: For each window size, the window size, the manifest of the task and the (relname, basin, iso_time, window)
+             of each window to append to the store, or the (month, features, labels, space-time, index) of each
+             sample to append to the arrays (empty with the netcdf backend); and the durations of the
+             open, select, cut, attrs and write stages of the task, see add_timing.
+    """
+    day, dataname, day_df, sizes, options = task
+    outputpath = options['outputpath']
+    results = [(windowsize, {'day': day, 'dataname': dataname, 'backend': options['backend'],
+                             'entries': entry_keys(day_df), 'finished': [], 'faulty': [], 'outside': [], 'omitted': [],
+                             'bytes': [0, 0]}, [])
+               for windowsize, latsize, lonsize in sizes]
+    timings = {}
+    reasons = day_df['ISO_TIME'].map(check_time)
+    for index, reason in reasons[reasons.notna()].items():
+        print('Faulty entry ' + day_df.loc[index, 'ISO_TIME'] + ' ' + reason + '.', flush=True)
+        for windowsize, manifest, windows in results:
+            manifest['faulty'].append([day_df.loc[index, 'ISO_TIME'], reason])
+    day_df = day_df[reasons.isna()]
+    if dataname is None:
+        for index, window_df in day_df.iterrows():
+            print('Faulty entry ' + window_df['ISO_TIME'] + ' missing MERRA-2 file.', flush=True)
+            for windowsize, manifest, windows in results:
+                manifest['faulty'].append([window_df['ISO_TIME'], 'missing MERRA-2 file'])
+    elif len(day_df) > 0:
+        #
+        # Pad once for the largest window, the windows of every size are then slices of the same slab
+        #
+        pad = max(lonsize for windowsize, latsize, lonsize in sizes)
+        slices = read_slices(dataname, day_df, pad, options, timings)
+        if options['prefetch'] > 0:
+            slices = read_ahead(slices, options['prefetch'], timings)
+        writer = None
+        if options['nwriters'] > 0 and options['backend'] == 'netcdf':
+            writer = concurrent.futures.ThreadPoolExecutor(options['nwriters'])
+        writes = collections.deque()
+        try:
+            for time, time_df, snapshot, nlat, nlon in slices:
+                formatted_datetime = datetime.strptime(time, '%Y-%m-%d %H:%M:%S').strftime('%Y%m%d%H')
+                for (windowsize, latsize, lonsize), (_, manifest, windows) in zip(sizes, results):
+                    bounds, inside = window_bounds(time_df['LAT'], time_df['LON'], latsize, lonsize, nlat, nlon, pad)
+                    for (index, window_df), bound, is_inside in zip(time_df.iterrows(), bounds, inside):
+                        if not is_inside:
+                            print('Cannot create a window of designed size for this TC, outside of map.', flush=True)
+                            print('ASDFGHJ' + window_df['ISO_TIME'] + window_df['NAME'] + window_df['BASIN'], flush=True)
+                            manifest['outside'].append([window_df['ISO_TIME'], window_df['NAME'], window_df['BASIN']])
+                            continue
+                        start = timer()
+                        window = snapshot.isel(lat=slice(bound[0], bound[1]), lon=slice(bound[2], bound[3]))
+                        start = add_timing(timings, 'cut', start)
+                        window = window.assign_attrs(VMAX=window_df['WMO_WIND'],
+                                                     PMIN=window_df['WMO_PRES'],
+                                                     RMW=window_df['USA_RMW'],
+                                                     CLAT=window_df['LAT'],
+                                                     CLON=window_df['LON'],
+                                                     TCNAME=window_df['NAME'])
+                        start = add_timing(timings, 'attrs', start)
+                        if options['backend'] == 'stream':
+                            relname = window_relname(window_df['BASIN'], formatted_datetime, windowsize, window_df['SUFFIX'])
+                            sample = stream_sample(window, relname, formatted_datetime, options['omit_percent'], options['channels'])
+                            add_timing(timings, 'sample', start)
+                            if sample is None:
+                                manifest['omitted'].append(relname)
+                            else:
+                                windows.append((formatted_datetime[4:6] if options['monthly'] else '',) + sample)
+                            manifest['finished'].append(relname)
+                            continue
+                        if options['backend'] == 'store':
+                            relname = window_relname(window_df['BASIN'], formatted_datetime, windowsize, window_df['SUFFIX'])
+                            #
+                            # Copy the window out of the padded slice, so that only the windows stay in memory
+                            # until the day is appended to the store, not every padded slice of the day
+                            #
+                            windows.append((relname, window_df['BASIN'], time, window.copy(deep=True)))
+                            manifest['finished'].append(relname)
+                            continue
+                        outname = window_filename(outputpath, window_df['BASIN'], formatted_datetime, windowsize, window_df['SUFFIX'])
+                        if writer is None:
+                            written = write_window(window, outname, timings, options['encoding'])
+                            manifest['bytes'] = [a + b for a, b in zip(manifest['bytes'], written)]
+                        else:
+                            if len(writes) >= options['write_queue']:
+                                written_manifest, write = writes.popleft()
+                                written_manifest['bytes'] = [a + b for a, b in zip(written_manifest['bytes'], write.result())]
+                            writes.append((manifest, writer.submit(write_window, window, outname, timings, options['encoding'])))
+                        manifest['finished'].append(outname)
+            while len(writes) > 0:
+                written_manifest, write = writes.popleft()
+                written_manifest['bytes'] = [a + b for a, b in zip(written_manifest['bytes'], write.result())]
+        finally:
+            slices.close()     # stops the reader thread of read_ahead and closes the MERRA-2 file if the loop failed
+            if writer is not None:
+                writer.shutdown()
+    if options['backend'] == 'netcdf':
+        for windowsize, manifest, windows in results:
+            write_manifest(manifest_filename(outputpath, windowsize, day), manifest)
+    return results, timings
+
+#########################################
+
+
+def report_day(result, options):
+    """
+    Append the windows of a finished day task to the stores or its samples to the training arrays if
+    needed, write its manifests, add its result and timings to the counters and print progress information.
+
+    Parameters:
+    - result (tuple): The window size, manifest and windows of each window size and the timings returned
+                      by extract_day.
+    - options (dict): The options of the task.
+
+    Returns:
+    None
+    """
+    global count
+    global faulty
+    global omit
+    global ndays
+    global nbytes
+    results, day_timings = result
+    for stage, durations in day_timings.items():
+        timings.setdefault(stage, []).extend(durations)
+    day = results[0][1]['day']
+    for windowsize, manifest, windows in results:
+        sizename = str(windowsize[0]) + 'x' + str(windowsize[1])
+        if options['incremental']:
+            #
+            # Only the entries whose window is written are indexed, the others are retried by the next run
+            #
+            finished = set(manifest['finished'])
+            reasons = {iso_time: reason for iso_time, reason in manifest['faulty']}
+            for key, value in pending[day].items():
+                if key in indexes[sizename]:
+                    outname = index_window(options['outputpath'], key, indexes[sizename].pop(key), windowsize)
+                    if outname not in finished and os.path.isfile(outname):
+                        os.remove(outname)     # the window of the previous record is out of date
+                if index_window(options['outputpath'], key, value, windowsize) in finished:
+                    indexes[sizename][key] = value
+                    failures[sizename].pop(key, None)
+                else:
+                    failures[sizename][key] = value + [reasons.get(key.split('|')[0], 'outside of map')]
+            updated.add(sizename)
+        if options['backend'] == 'store':
+            start = nsample[sizename]
+            writestart = timer()
+            if len(windows) > 0:
+                nsample[sizename] = append_store(store_filename(options['outputpath'], windowsize, options['suffix']), windows, start)
+                add_timing(timings, 'write', writestart)
+            manifest['samples'] = [start, nsample[sizename]]
+            write_manifest(manifest_filename(options['outputpath'], windowsize, manifest['day'], options['backend'],
+                                             options['suffix']), manifest)
+        if options['backend'] == 'stream':
+            outnames = stream_outnames(windowsize, options['suffix'], options['channels'])
+            writestart = timer()
+            for month in sorted(set(sample[0] for sample in windows)):
+                samples = [sample[1:] for sample in windows if sample[0] == month]
+                layouts[sizename].append([day, month, len(samples)])
+                for k in range(len(outnames)):
+                    with NpyAppendArray(options['streampath'] + outnames[k] + month + '.npy') as npaa:
+                        npaa.append(np.concatenate([sample[k] for sample in samples], axis=0))
+            if len(windows) > 0:
+                add_timing(timings, 'write', writestart)
+            omit += len(manifest['omitted'])
+            write_manifest(manifest_filename(options['outputpath'], windowsize, manifest['day'], options['backend'],
+                                             options['suffix']), manifest)
+        count += len(manifest['finished'])
+        faulty += len(manifest['faulty']) + len(manifest['outside'])
+        nbytes = [a + b for a, b in zip(nbytes, manifest.get('bytes', [0, 0]))]
+    entries_processed = count + faulty
+    entries = options['entries']
+    progress_percentage = (entries_processed / entries) * 100 if entries > 0 else 100
+    time_used = timer() - options['starttime']
+    if options['incremental']:
+        del pending[day]
+        if timer() - index_saved > 60:
+            save_indexes(options['outputpath'], updated, options['shard_index'], options['shard_count'])
+            updated.clear()
+    print(f'Day {day} done. {entries_processed} entries processed over {entries}, {progress_percentage:.2f}% done.'
+          f' Time used: {time_used:.2f}', flush=True)
+    ndays += 1
+    if options['timing_every'] > 0 and ndays % options['timing_every'] == 0:
+        report_timing(timings, time_used, entries, options['timingfile'])
+
+#########################################
+
+
+def extract_by_day(filtered_df, windowsizes, datapath='', outputpath='', completed=0,
+                   nworkers=1, resume=False, variables='', levels='', backend='netcdf', streampath='',
+                   monthly=False, omit_percent=5, catalog='', timingfile='', timing_every=50,
+                   incremental=False, prefetch=0, nwriters=0, write_queue=16, encoding='', shard_index=0,
+                   shard_count=1, starttime=None, channels=None):
+    """
+    Cut TC windows with the best track entries grouped by MERRA-2 day file and 3-hourly time, so that
+    each day file is opened once and each time slice is loaded once for all the TCs active at that time
+    and all the window sizes. Output files and names are the same as for the row by row loop in merge_data
+    run once per window size, or the windows are appended to a consolidated store per window size in the
+    order of the days with backend='store'. With backend='stream', no window is written: the channels used
+    for training are selected, screened for NaN and appended to the feature/label/space-time/index arrays
+    of TC-extract_data(_TSU).py in a single pass.
+
+    Each day is an independent task, which can be distributed over a pool of worker processes. Every
+    finished task writes a manifest per window size of its finished, faulty and out-of-map entries under
+    TC_manifest/, so that a rerun with resume=True skips exactly the days and window sizes whose manifest
+    matches their entries and MERRA-2 file (a day redone once its missing file is available).
+
+    With incremental=True, the entries are diffed against the index of the entries extracted by previous
+    runs (see index_records), and only the new or changed ones are extracted. The index is updated as the
+    days finish and written atomically at least every minute and at the end. Faulty and out-of-map entries
+    are kept in a separate index and extracted again by the next run. Indexed entries that are no longer
+    selected (e.g. removed from IBTrACS, or filtered out) are pruned together with their windows, so the
+    TC_domain tree always holds the windows of the current selection.
+
+    With shard_count > 1, only the days hashed to shard_index are processed (see shard_of), so that the
+    shards of a job array share the work without talking to each other. The NetCDF windows and manifests
+    of the shards do not overlap, while the stores, training arrays, indexes and timing files of each shard
+    get a suffix (see shard_suffix). The training arrays of the shards are merged by merge_stream_shards.
+
+    Parameters:
+    - filtered_df (DataFrame): The filtered best track data, sorted by ISO_TIME.
+    - windowsizes (list): The window sizes [lat, lon] in degree, e.g. [[18, 18], [30, 30]].
+    - datapath (str): Path to the MERRA-2 data.
+    - outputpath (str): Root of the output, under which TC_domain/ is created.
+    - completed (int): Number of entries processed by a previous run, which are skipped.
+    - nworkers (int): Number of worker processes. Default is 1 (no pool).
+    - resume (bool): If True, skip the days finished by a previous run. Default is False.
+    - variables (str or list): The variable(s) read and written to the windows. All if ''.
+    - levels (float or list): The pressure level(s) read and written to the windows. All if ''.
+    - backend (str): 'netcdf' for one NetCDF file per window, 'store' for the consolidated stores, 'stream'
+                     for the training arrays.
+    - streampath (str): Output directory of the training arrays with backend='stream'.
+    - monthly (bool): If True, the training arrays are split by month as in TC-extract_data_TSU.py.
+    - omit_percent (float): Upper limit of acceptable NaN percentage in the 850mb band of a sample.
+    - catalog (str): Catalog file of the MERRA-2 files, see load_catalog. If '', the file of each day
+                     is found with get_runid.
+    - timingfile (str): JSON file of the timing summary, see report_timing. Not written if ''.
+    - timing_every (int): Number of days between two timing reports, besides the final one. None if 0.
+    - incremental (bool): If True, extract only the entries not in the index of each window size, or
+                          changed since. Only supported by the netcdf backend. Default is False.
+    - prefetch (int): Number of time slices read ahead by a reader thread in each task. None if 0.
+    - nwriters (int): Number of writer threads writing the NetCDF windows of each task. None if 0.
+    - write_queue (int): Maximum number of windows waiting for the writer threads of each task.
+    - encoding (dict): Compression and packing of the NetCDF windows, see window_encoding. None if ''.
+    - shard_index (int): The shard processed by this run, in [0, shard_count). Default is 0.
+    - shard_count (int): The number of shards the days are split into. Default is 1 (no sharding).
+    - starttime (float): The timer() value at the start of the run, from which the time used is reported.
+                         Now if None.
+    - channels (list): The (variable, level) of each channel of the training arrays, see channel_list.
+                       The 13 channels of TC-extract_data.py if None.
+
+    Returns:
+    - int: Number of entries over all window sizes, including those done by a previous run.
+    """
+    global count
+    global faulty
+    global nsample
+    global omit
+    global timings
+    global ndays
+    global done_before
+    global indexes
+    global pending
+    global failures
+    global updated
+    global index_saved
+    global nbytes
+    global layouts
+    timings = {}
+    nbytes = [0, 0]
+    ndays = 0
+    sizes = [(windowsize,) + window_halfsizes(windowsize) for windowsize in windowsizes]
+    #
+    # The suffix follows the sorted order of entries sharing the same time, as in the row by row loop.
+    # It is assigned before the tasks are split, so it does not depend on which worker finishes first.
+    #
+    filtered_df = filtered_df.assign(SUFFIX=filtered_df.groupby('ISO_TIME', sort=False).cumcount())
+    selected = set(index_records(filtered_df)) if incremental and backend == 'netcdf' else set()
+    count = min(completed, len(filtered_df)) * len(sizes)
+    filtered_df = filtered_df.iloc[min(completed, len(filtered_df)):]
+    options = {'datapath': datapath, 'outputpath': outputpath, 'variables': variables, 'levels': levels,
+               'backend': backend, 'streampath': streampath, 'monthly': monthly, 'omit_percent': omit_percent,
+               'timingfile': timingfile, 'timing_every': timing_every, 'incremental': incremental,
+               'prefetch': prefetch, 'nwriters': nwriters, 'write_queue': write_queue, 'encoding': encoding,
+               'shard_index': shard_index, 'shard_count': shard_count, 'suffix': shard_suffix(shard_index, shard_count),
+               'starttime': timer() if starttime is None else starttime, 'channels': channel_list(channels)}
+    if shard_count > 1 and timingfile != '':
+        timingfile = os.path.splitext(timingfile)[0] + options['suffix'] + os.path.splitext(timingfile)[1]
+        options['timingfile'] = timingfile
+    #
+    # Samples of the stores are committed day by day, a rerun writes after the last committed sample.
+    # The samples of a day extracted again are invalidated rather than written over, so that the
+    # ranges recorded by old manifests never point to samples of another day.
+    #
+    nsample = {}
+    stale = {}
+    layouts = {}
+    for windowsize, latsize, lonsize in sizes:
+        nsample[str(windowsize[0]) + 'x' + str(windowsize[1])] = 0
+        layouts[str(windowsize[0]) + 'x' + str(windowsize[1])] = []
+        stale[str(windowsize[0]) + 'x' + str(windowsize[1])] = []
+        storename = store_filename(outputpath, windowsize, options['suffix'])
+        if backend == 'store' and not resume and os.path.isfile(storename):
+            print('Removing previous store ' + storename, flush=True)
+            os.remove(storename)
+    #
+    # The training arrays cannot be rolled back to the last finished day, so streaming always starts cold
+    #
+    omit = 0
+    if backend == 'stream':
+        if resume:
+            print('Resume is not supported by the stream backend, rebuilding all arrays.', flush=True)
+            resume = False
+        if variables == '' and levels == '':
+            options['variables'] = list(dict.fromkeys(name for name, level in options['channels']))
+            options['levels'] = sorted(set(level for name, level in options['channels'] if level is not None)) or ''
+        for windowsize in windowsizes:
+            stream_cold_start(streampath, windowsize, options['suffix'], options['channels'])
+            write_channel_spec(streampath, windowsize, options['suffix'], options['channels'])
+    #
+    # Stores and training arrays cannot drop the samples of changed entries, so they are rebuilt instead
+    #
+    if incremental and backend != 'netcdf':
+        print('Incremental mode is only supported by the netcdf backend, extracting all entries.', flush=True)
+        options['incremental'] = incremental = False
+    if incremental:
+        indexes = {}
+        failures = {}
+        updated = set()
+        for windowsize in windowsizes:
+            sizename = str(windowsize[0]) + 'x' + str(windowsize[1])
+            #
+            # Read the indexes of all shards, the one of this shard last, in case the shard count changed
+            #
+            for kind, loaded in [('index', indexes), ('faulty', failures)]:
+                index = {}
+                ownname = index_filename(outputpath, windowsize, options['suffix'], kind)
+                filenames = glob.glob(manifest_filename(outputpath, windowsize, kind + '*'))
+                for filename in sorted(name for name in filenames if name != ownname) + [ownname]:
+                    index.update(read_manifest(filename) or {})
+                loaded[sizename] = index
+            #
+            # Prune the entries of this shard no longer selected, and their windows
+            #
+            removed = [key for key in indexes[sizename] if key not in selected
+                       and (shard_count <= 1 or shard_of(key[:10], shard_count) == shard_index)]
+            for key in removed:
+                outname = index_window(outputpath, key, indexes[sizename].pop(key), windowsize)
+                if os.path.isfile(outname):
+                    os.remove(outname)
+            dropped = [key for key in failures[sizename] if key not in selected
+                       and (shard_count <= 1 or shard_of(key[:10], shard_count) == shard_index)]
+            for key in dropped:
+                del failures[sizename][key]
+            if len(removed) > 0:
+                print(str(len(removed)) + ' ' + sizename + ' entries no longer selected, their windows are removed.', flush=True)
+            if len(removed) + len(dropped) > 0:
+                updated.add(sizename)
+        pending = {}
+        index_saved = timer()
+    if catalog != '':
+        files = load_catalog(datapath, catalog)
+    tasks = []
+    missing = []
+    unchanged = 0
+    for day, day_df in filtered_df.groupby(filtered_df['ISO_TIME'].str[:10]):
+        if shard_count > 1 and shard_of(day, shard_count) != shard_index:
+            continue
+        start = timer()
+        formatted_time = day.replace('-', '')
+        if catalog == '':
+            dataname = datapath + 'MERRA2_' + str(get_runid(formatted_time, datapath)) + '.inst3_3d_asm_Np.' + formatted_time + '.nc4'
+        elif formatted_time in files:
+            dataname = datapath + files[formatted_time]
+        else:
+            dataname = None
+            missing.append(day)
+        add_timing(timings, 'catalog', start)
+        day_sizes = []
+        if incremental:
+            records = index_records(day_df)
+            changed = np.zeros(len(day_df), dtype=bool)
+            for windowsize, latsize, lonsize in sizes:
+                index = indexes[str(windowsize[0]) + 'x' + str(windowsize[1])]
+                size_changed = np.array([index.get(key) != value for key, value in records.items()], dtype=bool)
+                if np.any(size_changed):
+                    day_sizes.append((windowsize, latsize, lonsize))
+                changed |= size_changed
+            #
+            # Entries changed for one size are extracted again for all sizes needing that day
+            #
+            unchanged += len(day_df) * len(sizes) - int(np.sum(changed)) * len(day_sizes)
+            day_df = day_df[changed]
+            pending[day] = {key: value for (key, value), is_changed in zip(records.items(), changed) if is_changed}
+            if len(day_sizes) > 0:
+                tasks.append((day, dataname, day_df, day_sizes, options))
+            continue
+        for windowsize, latsize, lonsize in sizes:
+            if resume:
+                manifest = read_manifest(manifest_filename(outputpath, windowsize, day, backend, options['suffix']))
+                sizename = str(windowsize[0]) + 'x' + str(windowsize[1])
+                if manifest is not None and manifest.get('backend', 'netcdf') == 'store' and backend == 'store':
+                    nsample[sizename] = max(nsample[sizename], manifest.get('samples', [0, 0])[1])
+                if (manifest is not None and manifest['entries'] == entry_keys(day_df)
+                        and manifest.get('backend', 'netcdf') == backend and manifest.get('dataname') == dataname):
+                    count += len(manifest['finished'])
+                    faulty += len(manifest['faulty']) + len(manifest['outside'])
+                    continue
+                if manifest is not None and manifest.get('backend', 'netcdf') == 'store' and backend == 'store':
+                    stale[sizename].append(manifest.get('samples', [0, 0]))
+            day_sizes.append((windowsize, latsize, lonsize))
+        if len(day_sizes) > 0:
+            tasks.append((day, dataname, day_df, day_sizes, options))
+    if backend == 'store' and resume:
+        for windowsize in windowsizes:
+            sizename = str(windowsize[0]) + 'x' + str(windowsize[1])
+            storename = store_filename(outputpath, windowsize, options['suffix'])
+            if os.path.isfile(storename):
+                invalidate_store(storename, nsample[sizename], stale[sizename])
+            if len(stale[sizename]) > 0:
+                print(str(len(stale[sizename])) + ' days of the ' + sizename + ' store extracted again, their previous samples are invalidated.', flush=True)
+    done_before = (count, faulty)
+    entries = count + faulty + sum(len(task[2]) * len(task[3]) for task in tasks)
+    options['entries'] = entries
+    if incremental:
+        print(str(unchanged) + ' entries unchanged since the last extraction.', flush=True)
+    if len(missing) > 0:
+        print(str(len(missing)) + ' days have no MERRA-2 file, their entries will be faulty: ' + ', '.join(missing), flush=True)
+    print(str(len(tasks)) + ' days to process, ' + str(count + faulty) + ' entries done before.', flush=True)
+    if nworkers > 1:
+        #
+        # Fork explicitly, so workers inherit this module instead of re-running the main call below,
+        # and keep the order of the days for the store and the training arrays
+        #
+        with multiprocessing.get_context('fork').Pool(nworkers) as pool:
+            if backend in ['store', 'stream']:
+                results = pool.imap(extract_day, tasks)
+            else:
+                results = pool.imap_unordered(extract_day, tasks)
+            for result in results:
+                report_day(result, options)
+    else:
+        for task in tasks:
+            report_day(extract_day(task), options)
+    if backend == 'stream':
+        print('With ' + str(omit) + ' samples omitted due to NaNs.', flush=True)
+    if incremental:
+        save_indexes(outputpath, updated, shard_index, shard_count)
+    if backend == 'stream' and shard_count > 1:
+        for windowsize in windowsizes:
+            write_manifest(streampath + stream_outnames(windowsize, options['suffix'], options['channels'])[0] + '.json',
+                           layouts[str(windowsize[0]) + 'x' + str(windowsize[1])])
+    report_timing(timings, timer() - options['starttime'], entries, timingfile)
+    return entries
+
+#########################################
+
+
 def merge_data(csvdataset, tc_name='', years='', minlat = -90.0
                , maxlat = 90.0, minlon = -180.0, maxlon = 180.0
                , regions='', maxwind=10000, minwind=0, maxpres=10000
                , minpres=0, maxrmw=10000, minrmw=0, windowsize=[18,18]
-               , datapath='', completed=0): 
+               , datapath='', completed=0, outputpath='/N/slate/kmluong/'
+               , grouped=False, nworkers=1, resume=False, variables=''
+               , levels='', ibtracs_cache='', backend='netcdf', streampath=''
+               , monthly=False, omit_percent=5, catalog='', timingfile=''
+               , timing_every=50, incremental=False, prefetch=0, nwriters=0
+               , write_queue=16, encoding='', shard_index=0, shard_count=1, channels=None):
                #define a search bar for you, csvdataset is the link to the dataset, 
                #tc_name are names to search for, years are years to search for, .... 
                #Window size[lat,lon] is the intended output around the TC center, 
@@ -276,7 +1983,66 @@ def merge_data(csvdataset, tc_name='', years='', minlat = -90.0
         maxrmw (int): Maximum USA RMW. Default is 10000.
         minrmw (int): Minimum USA RMW. Default is 0.
         windowsize (tuple): The intended output window around the TC center. Default is (18, 18), lat, lon.
+                            A list of windows, e.g. [[18, 18], [25, 25], [30, 30]], cuts all sizes from each
+                            loaded time slice in a single pass over MERRA-2 (grouped mode). Smaller windows can
+                            also be served as views of the largest one with crop_window.
         datapath (str): Path to the data. Default is ''.
+        completed (int): Number of entries processed by a previous run, which are skipped. Default is 0.
+        outputpath (str): Path to the output, under which TC_domain/ is created. Default is '/N/slate/kmluong/'.
+        grouped (bool): If True, group entries by MERRA-2 day file and time so that each file is opened
+                        once and each time slice is loaded once. Default is False.
+        nworkers (int): Number of worker processes sharing the days of the grouped mode. Default is 1.
+        resume (bool): If True, skip the days already finished according to the per-day manifests written
+                       by the grouped mode under TC_manifest/. Default is False.
+        variables (str or list): Variable(s) to read and write to the windows, e.g. ['U', 'V', 'T', 'RH', 'SLP'].
+                                 Default is '' for all variables.
+        levels (float or list): Pressure level(s) in hPa to read and write to the windows, e.g. [750, 850, 950].
+                                Default is '' for all 42 levels.
+        ibtracs_cache (str): NumPy record file caching the numeric IBTrACS entries, memory-mapped and queried
+                             instead of re-reading the CSV. Rebuilt when the CSV changes. Default is '' (no cache).
+        backend (str): 'netcdf' to write one NetCDF file per window, or 'store' (grouped mode only) to append
+                       all windows to a single chunked NetCDF4/HDF5 store TC_domain/MERRA_TC{size}.nc, read
+                       with open_store, or 'stream' (grouped mode only) to append the channels of each window
+                       directly to the CNNfeatures/CNNlabels/CNNspace_time_info/CNNindex arrays of TC-extract_data(_TSU).py,
+                       without writing any window. Default is 'netcdf'.
+        streampath (str): Output directory of the arrays with backend='stream', e.g. exp_13features_18x18/.
+        monthly (bool): If True, the stream arrays are split by month as in TC-extract_data_TSU.py. Default is False.
+        omit_percent (float): Upper limit of acceptable NaN percentage in the 850mb band of a streamed sample.
+                              Default is 5.
+        catalog (str): JSON catalog of the MERRA-2 files in datapath, built once by scanning datapath and reused
+                       by later runs, so that the grouped mode does not probe the file of each day with get_runid
+                       and reports the missing days up front. Default is '' (no catalog).
+        timingfile (str): JSON file of the per-stage timing summary of the grouped mode (catalog lookup, open,
+                          time select, window cut, attribute assignment and write: count, total, mean, p50, p95),
+                          with the throughput in entries and windows per second. The summary is also printed
+                          as a line starting with TIMING. Default is '' (printed only).
+        timing_every (int): Number of days between two timing reports, besides the final one. Default is 50.
+        incremental (bool): If True, extract only the entries that are new or changed (position, intensity or
+                            file suffix) since the previous extractions, according to the index of extracted
+                            entries kept in TC_manifest/<size>/index.json, e.g. for a new IBTrACS release or
+                            MERRA-2 month (grouped mode, netcdf backend). Faulty entries are retried by the
+                            next run, and the windows of entries no longer selected are removed. Default is False.
+        prefetch (int): Number of time slices read ahead by a reader thread while the windows of the current
+                        slice are cut, in each worker (grouped mode). Up to prefetch+2 slices are in memory per
+                        worker, a slice of all 42 levels taking about 210 MB. Default is 0 (no reader thread).
+        nwriters (int): Number of writer threads draining the NetCDF windows of each worker to disk (grouped
+                        mode, netcdf backend). Default is 0 (windows written as they are cut).
+        write_queue (int): Maximum number of windows waiting for the writer threads of a worker, so that the
+                           memory stays bounded. Default is 16.
+        encoding (dict): Per-variable compression (zlib/zstd/blosc level, shuffle), chunking and packing (int16
+                         scale/offset or float16 precision) of the NetCDF windows, e.g. {'default': {'compression':
+                         'zlib', 'complevel': 4, 'packing': 'int16'}}, see window_encoding. The windows are decoded
+                         back to float32 by xr.open_dataset, and the bytes saved are reported in the timing summary,
+                         also printed at the end of the row by row loop. Default is '' (uncompressed float32).
+        shard_index (int): The shard of the days processed by this run, in [0, shard_count), e.g. the task id of
+                           a job array (grouped mode). Default is 0.
+        shard_count (int): The number of shards, e.g. the number of tasks of a job array. The days are assigned
+                           to the shards by a fixed hash of their date. The stream arrays of the shards are merged
+                           afterwards with merge_stream_shards. Default is 1 (no sharding).
+        channels (list): The (variable, level) of each channel of the stream arrays, with level None for the
+                         surface fields, e.g. [('U', 850), ('V', 850), ('T', 850), ('RH', 850), ('SLP', None)].
+                         The layout is written next to the arrays as in TC-extract_data.py. Default is None
+                         (the 13 channels of TC-extract_data.py).
 
     Returns:
         None
@@ -290,27 +2056,33 @@ def merge_data(csvdataset, tc_name='', years='', minlat = -90.0
   """
   #############################################################################
   #read CSV data and process the datatype, selecting only TC with defined characteristics
-  selected_columns = ["SEASON", "BASIN", "NAME", "LAT", 
-                      "LON", "ISO_TIME", "WMO_WIND", 
-                      "WMO_PRES", "USA_RMW"]                          #define the important columns, some for search bar, some for interest
-  df=pd.read_csv(csvdataset, usecols=selected_columns, keep_default_na=False); #read data using pandas read csv
-  filtered_df = df[
-    (df['WMO_WIND'].apply(lambda x: str(x).isnumeric())) & 
-    (df['WMO_PRES'].apply(lambda x: str(x).isnumeric())) & 
-    (df['USA_RMW'].apply(lambda x: str(x).isnumeric()))][selected_columns] #pick only where max wind speed, min pressure, and RMW are numbers
-  filtered_df["WMO_WIND"] = filtered_df["WMO_WIND"].astype(float) 
-  #still need to convert them to number, because >>some<< entries are strings, that's why I have to use isnumeric.
-  filtered_df["WMO_PRES"] = filtered_df["WMO_PRES"].astype(float)
-  filtered_df["USA_RMW"] = filtered_df["USA_RMW"].astype(float)
-  del df #liberate some data, for other users
-  filtered_df=process_years(years, filtered_df) #search bar
-  filtered_df=process_name(tc_name, filtered_df)
-  filtered_df=process_regions(regions, filtered_df)
-  filtered_df=trim_area(filtered_df, maxlat=maxlat,minlat=minlat,maxlon=maxlon,minlon=minlon)
-  filtered_df=trim_wind_range(filtered_df, maxwind=maxwind, minwind=minwind)
-  filtered_df=trim_pressure_range(filtered_df, maxpres=maxpres, minpres=minpres)
-  filtered_df=trim_rmw_range(filtered_df, maxrmw=maxrmw, minrmw=minrmw)
-  filtered_df=filtered_df.sort_values('ISO_TIME')
+  if ibtracs_cache != '':
+    filtered_df = query_besttrack(load_besttrack(csvdataset, ibtracs_cache), tc_name=tc_name, years=years,
+                                  minlat=minlat, maxlat=maxlat, minlon=minlon, maxlon=maxlon, regions=regions,
+                                  maxwind=maxwind, minwind=minwind, maxpres=maxpres, minpres=minpres,
+                                  maxrmw=maxrmw, minrmw=minrmw)
+  else:
+    selected_columns = ["SEASON", "BASIN", "NAME", "LAT", 
+                        "LON", "ISO_TIME", "WMO_WIND", 
+                        "WMO_PRES", "USA_RMW"]                          #define the important columns, some for search bar, some for interest
+    df=pd.read_csv(csvdataset, usecols=selected_columns, keep_default_na=False); #read data using pandas read csv
+    filtered_df = df[
+      (df['WMO_WIND'].apply(lambda x: str(x).isnumeric())) & 
+      (df['WMO_PRES'].apply(lambda x: str(x).isnumeric())) & 
+      (df['USA_RMW'].apply(lambda x: str(x).isnumeric()))][selected_columns] #pick only where max wind speed, min pressure, and RMW are numbers
+    filtered_df["WMO_WIND"] = filtered_df["WMO_WIND"].astype(float) 
+    #still need to convert them to number, because >>some<< entries are strings, that's why I have to use isnumeric.
+    filtered_df["WMO_PRES"] = filtered_df["WMO_PRES"].astype(float)
+    filtered_df["USA_RMW"] = filtered_df["USA_RMW"].astype(float)
+    del df #liberate some data, for other users
+    filtered_df=process_years(years, filtered_df) #search bar
+    filtered_df=process_name(tc_name, filtered_df)
+    filtered_df=process_regions(regions, filtered_df)
+    filtered_df=trim_area(filtered_df, maxlat=maxlat,minlat=minlat,maxlon=maxlon,minlon=minlon)
+    filtered_df=trim_wind_range(filtered_df, maxwind=maxwind, minwind=minwind)
+    filtered_df=trim_pressure_range(filtered_df, maxpres=maxpres, minpres=minpres)
+    filtered_df=trim_rmw_range(filtered_df, maxrmw=maxrmw, minrmw=minrmw)
+    filtered_df=filtered_df.sort_values('ISO_TIME')
 
 
   ###############################################################################
@@ -329,10 +2101,30 @@ def merge_data(csvdataset, tc_name='', years='', minlat = -90.0
   entries=len(filtered_df)
   global endtime
   endtime=0
+  global nbytes
+  nbytes=[0, 0]
+  global done_before
+  done_before=(min(completed, entries), 0)
+  timings={}
   print('Total: ' + str(entries), flush=True)
-  latsize = int(np.ceil((np.ceil(windowsize[0]/0.5)+1)/2))  #change 0.625 and 0.5 for other dataset
-  lonsize = int(np.ceil((np.ceil(windowsize[1]/0.625)+1)/2))
   filtered_df['LON']=filtered_df['LON'] - 360*np.logical_and(filtered_df['BASIN'].isin(['EP','SP']), filtered_df['LON']>0)
+  if np.ndim(windowsize) == 2:
+    windowsizes = [list(size) for size in windowsize] #several window sizes cut in a single pass
+  else:
+    windowsizes = [windowsize]
+  if (grouped or nworkers > 1 or backend != 'netcdf' or len(windowsizes) > 1 or incremental
+      or prefetch > 0 or nwriters > 0 or shard_count > 1):
+    entries = extract_by_day(filtered_df, windowsizes, datapath=datapath, outputpath=outputpath,
+                   completed=completed, nworkers=nworkers, resume=resume, variables=variables, levels=levels,
+                   backend=backend, streampath=streampath, monthly=monthly, omit_percent=omit_percent,
+                   catalog=catalog, timingfile=timingfile, timing_every=timing_every, incremental=incremental,
+                   prefetch=prefetch, nwriters=nwriters, write_queue=write_queue, encoding=encoding,
+                   shard_index=shard_index, shard_count=shard_count, starttime=starttime, channels=channels)
+    print('Total: ' + str(entries) + ' entries processed' + (' over ' + str(len(windowsizes)) + ' window sizes.' if len(windowsizes) > 1 else '.'), flush=True)
+    print('With ' +str(faulty) +' faulty entries.', flush=True)
+    print('Generated ' + str(count) + ' windows.', flush=True)
+    return
+  latsize, lonsize = window_halfsizes(windowsize)
   ################################################################################
   #Loop through filtered data
   for index, row in filtered_df.iterrows():
@@ -372,7 +2164,7 @@ def merge_data(csvdataset, tc_name='', years='', minlat = -90.0
     upper_index_lat=int(gblat+latsize+1)
     formatted_time = pd.to_datetime(time).strftime('%Y%m%d') #read corresponding data file
     dataname=datapath+'MERRA2_'+str(get_runid(formatted_time,datapath))+'.inst3_3d_asm_Np.'+formatted_time+'.nc4'
-    dataset = xr.open_dataset(dataname)
+    dataset = select_fields(xr.open_dataset(dataname), variables, levels)
     if lower_index_lat<0 or upper_index_lat>len(dataset.lat)-1:
      faulty+=1
      print('Cannot create a window of designed size for this TC, outside of map.', flush=True)
@@ -406,7 +2198,7 @@ def merge_data(csvdataset, tc_name='', years='', minlat = -90.0
 			       #assign new attributes, Max wind speed, Min pressure and radius of maximum wind
     formatted_datetime = datetime.strptime(time, '%Y-%m-%d %H:%M:%S').strftime('%Y%m%d%H') #take YYYYMMDDHH format to build filename
     basin=window_df['BASIN']
-    outname='/N/slate/kmluong/'
+    outname=outputpath
     outname=outname+'TC_domain/'+basin 
     if not os.path.exists(outname):
      os.makedirs(outname)
@@ -415,15 +2207,24 @@ def merge_data(csvdataset, tc_name='', years='', minlat = -90.0
      os.makedirs(outname)
     outname=outname + '/' + 'MERRA_TC' + str(windowsize[0])+'x'+str(windowsize[1])+formatted_datetime + '_'+str(suffix)+ '.nc'
     outname=str(outname)
-    window.to_netcdf(outname) #print out the new file, its name is MERRA_TCW1xW2YYYYMMDDHH.nc
+    written=write_window(window, outname, timings, encoding) #print out the new file, its name is MERRA_TCW1xW2YYYYMMDDHH.nc
+    nbytes=[a + b for a, b in zip(nbytes, written)]
     count=count+1
     process_entries(round(entries*0.01/100)*100)
   print('Total: ' + str(entries) + ' entries processed.', flush=True)
   print('With ' +str(faulty) +' faulty entries.', flush=True)
   print('Generated ' + str(count) + ' windows.', flush=True) 
+  if encoding != '' or timingfile != '':
+    report_timing(timings, timer() - starttime, entries, timingfile) #bytes saved by the encoding and write time
 datapath='/N/u/tqluu/BigRed200/@PUBLIC/nasa-merra2-full/'
 csvdataset='/N/project/hurricane-deep-learning/data/tc/ibtracs.ALL.list.v04r00.csv'
 merge_data(csvdataset, regions=['EP', 'NA', 'WP'],windowsize=[30,30], datapath=datapath)
+#To process the days in parallel and resume an interrupted run, use e.g. grouped=True, nworkers=8, resume=True
+#To reuse the parsed best track data and the list of MERRA-2 files, use e.g. ibtracs_cache='/N/slate/kmluong/ibtracs.ALL.list.v04r00.npy', catalog='/N/slate/kmluong/MERRA2_catalog.json'
+#In a job array (sbatch --array=0-7), use shard_index=int(os.environ['SLURM_ARRAY_TASK_ID'])-int(os.environ['SLURM_ARRAY_TASK_MIN']), shard_count=int(os.environ['SLURM_ARRAY_TASK_COUNT'])
+#With backend='stream' in a job array, merge the arrays of all tasks afterwards with merge_stream_shards(streampath, windowsize, shard_count, channels)
 #For processing faulty window size, use minlon=171-0.625*3 and maxlon=-171+0.625*3 >>>max-windowsize+3gridsize<<<
 #tc_name (str or None), years (str or None), minlat (float), maxlat (float), minlon (float), maxlon (float), regions (str or None), maxwind (int), minwind (int), maxpres (int), minpres (int), maxrmw (int), minrmw (int), windowsize (tuple) default [18,18], datapath (str)  
+#To cut several window sizes in one pass over MERRA-2, use e.g. windowsize=[[18,18],[19,19],[25,25],[30,30]]
+#For the 13-channel experiments, only variables=['U', 'V', 'T', 'RH', 'SLP'] and levels=[750, 850, 950] are needed by TC-extract_data.py
 #Define parameters, only csvdataset is required, if no keyword argument is given, the function search for the whole domain            
@@ -1,39 +1,176 @@
-import xarray as xr
 import netCDF4 as nc
+import numpy as np
 import os
-count=0
+import re
+import json
+import collections
+import multiprocessing
+import concurrent.futures
+#
+# Check every TC window of the TC_domain tree written by MERRA2tc_domain.py. Only the NetCDF
+# header of each file is read (dimensions and attributes), plus its data when nan_check is on,
+# and all the offending files are listed in the report instead of stopping at the first one.
+#
 windows_path = "/N/slate/kmluong/TC_domain"
-oldlatdim=0
-oldlondim=0
-oldfile=0
-err=0
-print('Ini done', flush=True)
-for folder in os.listdir(windows_path):
- print(folder)
- for folder2 in os.listdir(windows_path+'/'+folder):
-  for file in os.listdir(windows_path+'/'+folder+'/'+folder2):
-   filepath=os.path.join(windows_path+'/'+folder+'/'+folder2+'/'+file)
-   dataset=xr.open_dataset(filepath)
-   latdim=len(dataset.lat)
-   londim=len(dataset.lon)
-   if count >0:
-    if latdim!=oldlatdim:
-     print('Oh no, this is lat', flush=True)
-     print(oldfile,filepath, oldlatdim, latdim)
-     err+=1
-     break
-    if londim!=oldlondim:
-     err+=1
-     print('Oh no, this is lon', flush=True)
-     print(oldfile, filepath, oldlondim, londim)
-     break
-   count+=1
-   if count<11:
-    print(count)
-   oldfile=filepath
-   oldlatdim=latdim
-   oldlondim=londim
-   if count%1000==0:
-    print(str(count)+' checked, total '+str(err)+' error.', flush=True)
-print('finish checking, total '+ str(err)+' error.')
+report_path = "check_window_report.json"
+nworkers = int(os.environ.get('SLURM_CPUS_PER_TASK', os.cpu_count()))  # processes reading the headers
+nwalkers = 16                   # threads listing the basin/year folders
+nan_check = True                # also read the data to compute the NaN fraction of each window
+max_nan_percent = 5             # same as omit_percent in MERRA2tc_domain.py and TC-extract_data.py
+expected_attrs = ['VMAX', 'PMIN', 'RMW', 'CLAT', 'CLON']
+#
+# Window names are MERRA_TC{size}{YYYYMMDDHH}_{suffix}.nc, e.g. MERRA_TC18x182005090100_0.nc
+#
+window_pattern = re.compile(r'MERRA_TC([\d.]+x[\d.]+)(\d{10})_\d+\.nc$')
+#
+#########################################
 
+def list_folder(folder):
+    """
+    List the window files of one basin/year folder.
+
+    Parameters:
+    - folder (str): The folder, e.g. TC_domain/NA/2005.
+
+    Returns:
+    - list: The paths of the NetCDF files in the folder.
+    """
+    with os.scandir(folder) as entries:
+        return [entry.path for entry in entries if entry.is_file() and entry.name.endswith('.nc')]
+
+#########################################
+
+def list_windows(windows_path, nwalkers=16):
+    """
+    List the window files of a TC_domain tree, walking the basin/year folders with a thread pool.
+    The consolidated stores MERRA_TC*.nc at the top of the tree are skipped (see open_store in
+    MERRA2tc_domain.py).
+
+    Parameters:
+    - windows_path (str): The TC_domain directory.
+    - nwalkers (int): The number of threads listing the folders.
+
+    Returns:
+    - list: The sorted paths of the window files.
+    """
+    folders = []
+    with os.scandir(windows_path) as basins:
+        for basin in basins:
+            if not basin.is_dir():
+                continue
+            with os.scandir(basin.path) as years:
+                folders.extend(year.path for year in years if year.is_dir())
+    filepaths = []
+    with concurrent.futures.ThreadPoolExecutor(max(1, nwalkers)) as walker:
+        for names in walker.map(list_folder, folders):
+            filepaths.extend(names)
+    return sorted(filepaths)
+
+#########################################
+
+def check_file(filepath, nan_check=True, max_nan_percent=5):
+    """
+    Check one window file. Opening a NetCDF file only reads its header; the variables are read
+    only when nan_check is on. Packed variables (see window_encoding in MERRA2tc_domain.py) are
+    unpacked by netCDF4, and their NaNs come back as masked values.
+
+    Parameters:
+    - filepath (str): The window file.
+    - nan_check (bool): Whether to read the data and compute the NaN fraction.
+    - max_nan_percent (float): The NaN percentage above which the window is reported.
+
+    Returns:
+    - dict: file, size (from the name), dims [lat, lon], nan_percent and the list of problems.
+    """
+    match = window_pattern.search(os.path.basename(filepath))
+    result = {'file': filepath, 'size': match.group(1) if match else None, 'dims': None,
+              'nan_percent': None, 'problems': []}
+    if match is None:
+        result['problems'].append('unexpected file name')
+    try:
+        with nc.Dataset(filepath) as dataset:
+            missing = [dim for dim in ('lat', 'lon') if dim not in dataset.dimensions]
+            if missing:
+                result['problems'].append('missing dimensions ' + ', '.join(missing))
+            else:
+                result['dims'] = [len(dataset.dimensions['lat']), len(dataset.dimensions['lon'])]
+            attrs = dataset.ncattrs()
+            for name in expected_attrs:
+                if name not in attrs:
+                    result['problems'].append('missing attribute ' + name)
+            for name in ('CLAT', 'CLON'):
+                if name in attrs and not np.isfinite(float(dataset.getncattr(name))):
+                    result['problems'].append('attribute ' + name + ' is not finite')
+            if nan_check and not missing:
+                nnan = 0
+                nvalue = 0
+                for name, variable in dataset.variables.items():
+                    if name in dataset.dimensions or 'lat' not in variable.dimensions:
+                        continue
+                    values = variable[:]
+                    nnan += int(np.count_nonzero(np.ma.getmaskarray(values) | np.isnan(np.ma.getdata(values))))
+                    nvalue += values.size
+                result['nan_percent'] = 100 * nnan / nvalue if nvalue > 0 else 0.
+                if result['nan_percent'] > max_nan_percent:
+                    result['problems'].append('NaN fraction ' + str(round(result['nan_percent'], 2)) + '%')
+    except (OSError, RuntimeError, ValueError) as e:
+        result['problems'].append('unreadable: ' + str(e))
+    return result
+
+#########################################
+
+def check_task(filepath):
+    """
+    Pool task checking one window file with the parameters of the script.
+    """
+    return check_file(filepath, nan_check=nan_check, max_nan_percent=max_nan_percent)
+
+#########################################
+
+def check_windows(windows_path, report_path, nworkers=1, nwalkers=16):
+    """
+    Check all the windows of a TC_domain tree and write the report of the offending files. The
+    expected dimensions of each window size are the most common ones among the files of that size,
+    so that trees cut with several window sizes (see merge_data) are checked per size.
+
+    Parameters:
+    - windows_path (str): The TC_domain directory.
+    - report_path (str): The JSON report, with the expected dimensions of each size, the counts,
+                         and the file, dims, NaN percentage and problems of each offending file.
+    - nworkers (int): The number of processes reading the headers.
+    - nwalkers (int): The number of threads listing the folders.
+
+    Returns:
+    - int: The number of offending files.
+    """
+    filepaths = list_windows(windows_path, nwalkers)
+    print('Found ' + str(len(filepaths)) + ' windows in ' + windows_path, flush=True)
+    results = []
+    # processes rather than threads, netCDF-C/HDF5 is not thread-safe (see netcdf_lock in MERRA2tc_domain.py)
+    with multiprocessing.get_context('fork').Pool(max(1, nworkers)) as pool:
+        for result in pool.imap_unordered(check_task, filepaths, chunksize=64):
+            results.append(result)
+            if len(results) % 10000 == 0:
+                print(str(len(results)) + ' checked.', flush=True)
+    dims = collections.defaultdict(collections.Counter)
+    for result in results:
+        if result['dims'] is not None:
+            dims[result['size']][tuple(result['dims'])] += 1
+    expected = {size: list(counter.most_common(1)[0][0]) for size, counter in dims.items()}
+    for result in results:
+        if result['dims'] is not None and result['dims'] != expected[result['size']]:
+            result['problems'].append('dims ' + str(result['dims']) + ', expected ' + str(expected[result['size']]))
+    offending = sorted((result for result in results if result['problems']), key=lambda result: result['file'])
+    report = {'windows_path': windows_path, 'checked': len(results), 'errors': len(offending),
+              'expected_dims': expected, 'nan_check': nan_check, 'max_nan_percent': max_nan_percent,
+              'files': offending}
+    with open(report_path, 'w') as f:
+        json.dump(report, f, indent=1)
+    for result in offending[:10]:
+        print(result['file'], '; '.join(result['problems']), flush=True)
+    print('finish checking ' + str(len(results)) + ' windows, total ' + str(len(offending)) + ' error, see ' + report_path, flush=True)
+    return len(offending)
+
+#########################################
+# MAIN CALL:
+check_windows(windows_path, report_path, nworkers=nworkers, nwalkers=nwalkers)